@@ -0,0 +1,21 @@
+import hmac
+import os
+
+from flask import jsonify, request
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+
+def check_admin_token():
+    """Return an error response unless the request carries ``Authorization: Bearer <ADMIN_TOKEN>``.
+
+    Admin routes are disabled entirely while ADMIN_TOKEN is unset.
+    """
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin routes are disabled. Set ADMIN_TOKEN to enable them.'}), 403
+    supplied = request.headers.get('Authorization', '')
+    if supplied.startswith('Bearer '):
+        supplied = supplied[len('Bearer '):]
+    if not hmac.compare_digest(supplied.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Invalid admin token'}), 401
+    return None
@@ -0,0 +1,185 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR', '/tmp/docx_artifacts')
+ARTIFACT_INDEX_PATH = os.environ.get('ARTIFACT_INDEX_PATH', os.path.join(ARTIFACT_DIR, 'index.sqlite3'))
+ARTIFACT_TTL = float(os.environ.get('ARTIFACT_TTL', 3600))
+ARTIFACT_MAX_BYTES = int(os.environ.get('ARTIFACT_MAX_BYTES', 1024 * 1024 * 1024))
+ARTIFACT_REAP_INTERVAL = float(os.environ.get('ARTIFACT_REAP_INTERVAL', 60))
+
+
+class FilesystemArtifactStore:
+    """Generated files on local disk, indexed in sqlite so every worker can serve them.
+
+    Each artifact expires after its TTL. When the total size exceeds
+    ``max_bytes`` the least recently downloaded artifacts are removed first.
+    """
+
+    def __init__(self, root, index_path, ttl, max_bytes, reap_interval):
+        self.root = root
+        self.index_path = index_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.reap_interval = reap_interval
+        self._local = threading.local()
+        self._reaper_pid = None
+        self._reaper_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            " file_id TEXT PRIMARY KEY,"
+            " path TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)")
+        # Asynchronous DOCX jobs, updated by the job process itself so any worker can report on them.
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " file_id TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " error TEXT,"
+            " pid INTEGER,"
+            " created REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.index_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def new_path(self, suffix='.docx'):
+        """Return a fresh path inside the store for a file that will be added with ``add``."""
+        return os.path.join(self.root, f"document_{uuid.uuid4()}{suffix}")
+
+    def add(self, path, file_id=None, ttl=None):
+        self.start_reaper()
+        file_id = file_id or str(uuid.uuid4())
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        self._connect().execute(
+            "INSERT OR IGNORE INTO artifacts (file_id, path, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (file_id, path, os.path.getsize(path), now + ttl, now)
+        )
+        self.enforce_quota()
+        return file_id
+
+    def get(self, file_id):
+        """Return the path of a live artifact, or None if it is unknown, expired or missing."""
+        self.start_reaper()
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute("SELECT path, expires_at FROM artifacts WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None:
+            return None
+        path, expires_at = row
+        if expires_at <= now or not os.path.exists(path):
+            self.delete(file_id)
+            return None
+        conn.execute("UPDATE artifacts SET last_access = ? WHERE file_id = ?", (now, file_id))
+        return path
+
+    def delete(self, file_id):
+        conn = self._connect()
+        row = conn.execute("SELECT path FROM artifacts WHERE file_id = ?", (file_id,)).fetchone()
+        conn.execute("DELETE FROM artifacts WHERE file_id = ?", (file_id,))
+        if row:
+            self._remove_file(row[0])
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove artifact {path}: {e}")
+
+    def enforce_quota(self):
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for file_id, size in conn.execute("SELECT file_id, size FROM artifacts ORDER BY last_access").fetchall():
+            self.delete(file_id)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def create_job(self, job_id, file_id, pid):
+        self.start_reaper()
+        self._connect().execute(
+            "INSERT INTO jobs (job_id, file_id, status, pid, created) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, file_id, pid, time.time())
+        )
+
+    def update_job(self, job_id, status, error=None, pid=None):
+        """Set a job's status; ``pid`` is the process now responsible for it, if it changed."""
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, error = ?, pid = COALESCE(?, pid) WHERE job_id = ?",
+            (status, error, pid, job_id)
+        )
+
+    def get_job(self, job_id):
+        """Return ``{'file_id', 'status', 'error', 'pid', 'created'}`` for a job, or None."""
+        row = self._connect().execute(
+            "SELECT file_id, status, error, pid, created FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('file_id', 'status', 'error', 'pid', 'created'), row))
+
+    def reap(self):
+        conn = self._connect()
+        now = time.time()
+        # A job's download link is useless once its artifact has expired.
+        conn.execute("DELETE FROM jobs WHERE created <= ?", (now - self.ttl,))
+        for file_id, in conn.execute("SELECT file_id FROM artifacts WHERE expires_at <= ?", (now,)).fetchall():
+            self.delete(file_id)
+        self.enforce_quota()
+
+        # Files that never made it into the index (failed or abandoned renders).
+        known = {path for path, in conn.execute("SELECT path FROM artifacts").fetchall()}
+        for entry in os.scandir(self.root):
+            if not entry.name.startswith('document_') or entry.path in known:
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    self._remove_file(entry.path)
+            except OSError:
+                continue
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logging.warning(f"Artifact reaper failed: {e}")
+
+    def start_reaper(self):
+        # Started lazily so each forked worker gets its own reaper thread.
+        if self._reaper_pid == os.getpid() or self.reap_interval <= 0:
+            return
+        with self._reaper_lock:
+            if self._reaper_pid != os.getpid():
+                threading.Thread(target=self._reap_forever, name='artifact-reaper', daemon=True).start()
+                self._reaper_pid = os.getpid()
+
+
+def create_artifact_store():
+    backend = os.environ.get('ARTIFACT_STORE_BACKEND', 'filesystem').lower()
+    if backend != 'filesystem':
+        raise ValueError(f"Unknown ARTIFACT_STORE_BACKEND: {backend}")
+    return FilesystemArtifactStore(ARTIFACT_DIR, ARTIFACT_INDEX_PATH, ARTIFACT_TTL,
+                                   ARTIFACT_MAX_BYTES, ARTIFACT_REAP_INTERVAL)
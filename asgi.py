@@ -0,0 +1,538 @@
+"""ASGI entry point: ``uvicorn asgi:application``.
+
+The I/O-bound plugin endpoints (/brave_search, /vectorize-rag-retrieve and
+synchronous JSON /generate_docx) are served natively on the event loop with a
+shared async HTTP client, so a worker is not tied up while it waits on Brave,
+Vectorize or image hosts. Every other route, and the preflight requests, are
+passed through to the Flask app.
+"""
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import brave_search
+import generate_docx
+import image_fetcher
+import json_codec
+import metrics
+import rate_limiter
+import upstream_client
+import upstream_guard
+import vectorize_query
+from main_app import app as flask_app
+from response_cache import make_cache_key
+from single_flight import AsyncSingleFlight
+
+# Threads serving the routes that are passed through to Flask.
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+# Threads rendering documents for the native /generate_docx route.
+ASGI_DOCX_THREADS = int(os.environ.get('ASGI_DOCX_THREADS', 4))
+ASGI_MAX_CONNECTIONS = int(os.environ.get('ASGI_MAX_CONNECTIONS', 100))
+MAX_CONTENT_LENGTH = flask_app.config['MAX_CONTENT_LENGTH']
+
+wsgi_application = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+docx_executor = ThreadPoolExecutor(max_workers=ASGI_DOCX_THREADS)
+brave_flight = AsyncSingleFlight()
+vectorize_flight = AsyncSingleFlight()
+
+_clients = {}
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+def get_client():
+    """Return the AsyncClient of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(upstream_client.READ_TIMEOUT, connect=upstream_client.CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ASGI_MAX_CONNECTIONS,
+                                max_keepalive_connections=upstream_client.POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=upstream_client.MAX_RETRIES),
+            cookies=CookieJar(policy=upstream_client.RejectCookies()),
+        )
+        _clients[loop] = client
+    return client
+
+
+async def close_clients():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(float(retry_after), upstream_client.MAX_RETRY_AFTER)
+    return upstream_client.BACKOFF_FACTOR * (2 ** attempt)
+
+
+async def _request_with_retries(method, url, idempotent=False, **kwargs):
+    client = get_client()
+    retries = upstream_client.MAX_RETRIES if idempotent or method in upstream_client.IDEMPOTENT_METHODS else 0
+    for attempt in range(retries + 1):
+        response = await client.request(method, url, **kwargs)
+        if response.status_code not in upstream_client.RETRY_STATUS_CODES or attempt == retries:
+            return response
+        await asyncio.sleep(_retry_delay(response, attempt))
+    return response
+
+
+def _retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+async def _hedged_request(guard, delay, method, url, kwargs):
+    primary = asyncio.ensure_future(_request_with_retries(method, url, **kwargs))
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not guard.take_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(_request_with_retries(method, url, **kwargs))
+        tasks.append(hedge)
+        pending = set(tasks)
+        first_done = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                first_done = first_done or task
+                if task.exception() is None and not upstream_guard.is_upstream_failure(task.result().status_code):
+                    guard.record_hedge(task is hedge)
+                    return task.result()
+        # Both attempts failed, so neither won: report the one that finished first.
+        return first_done.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.add_done_callback(_retrieve_exception)
+                task.cancel()
+
+
+async def upstream_request(upstream, method, url, credential=None, idempotent=False, **kwargs):
+    """Async counterpart of upstream_client.guarded_request, retrying the same status codes."""
+    guard = upstream_guard.get_guard(upstream, url, credential)
+    guard.before_request()
+    start = time.perf_counter()
+    kwargs['idempotent'] = idempotent
+    try:
+        delay = guard.hedge_delay() if idempotent or method in upstream_client.IDEMPOTENT_METHODS else None
+        if delay is None:
+            response = await _request_with_retries(method, url, **kwargs)
+        else:
+            response = await _hedged_request(guard, delay, method, url, kwargs)
+    except httpx.TransportError:
+        guard.record_failure()
+        raise
+    except BaseException:
+        guard.release()
+        raise
+    guard.record_response(response.status_code, time.perf_counter() - start)
+    return response
+
+
+# --- Brave search -----------------------------------------------------------
+
+async def fetch_brave_data(api_key, params):
+    logging.info(f"Requesting Brave API. Query: '{params['q']}', Params: {params}")
+    async with rate_limiter.limit_async('brave', api_key):
+        with metrics.stage('upstream'):
+            response = await upstream_request('brave', 'GET', brave_search.BRAVE_API_URL, credential=api_key, params=params,
+                                              headers=brave_search.brave_request_headers(api_key))
+            response.raise_for_status()
+    metrics.record_upstream_bytes('brave', len(response.content))
+    with metrics.stage('parse'):
+        return json_codec.loads(response.content)
+
+
+async def fetch_brave_summary(api_key, params, cache_key):
+    brave_data = await fetch_brave_data(api_key, params)
+    with metrics.stage('format'):
+        summary = brave_search.format_brave_response_comprehensive(brave_data)
+    await asyncio.to_thread(brave_search.brave_cache.set, cache_key, summary, ttl=brave_search.brave_cache_ttl(params))
+    return summary
+
+
+def _retry_after(err):
+    return [(b'retry-after', err.retry_after_header.encode('latin-1'))]
+
+
+def describe_brave_error(err):
+    if isinstance(err, (upstream_guard.CircuitOpenError, rate_limiter.RateLimitExceeded)):
+        return brave_search.describe_brave_error(err)
+    if isinstance(err, httpx.HTTPStatusError):
+        return brave_search.describe_brave_http_error(err.response)
+    if isinstance(err, httpx.HTTPError):
+        error_message = f'Network or Request error when calling Brave API: {str(err)}'
+        logging.error(error_message)
+        return error_message, 'Error connecting to the search service.', 500
+    return brave_search.describe_brave_error(err)
+
+
+async def handle_brave_search(body):
+    try:
+        data = json_codec.loads(body) if body else None
+        if not data:
+            logging.error("No JSON data provided in request.")
+            return 400, {'error': 'No JSON data provided', 'search_summary': 'Error: No input data received by server.'}
+
+        api_key = data.get('braveSearchAPIKey')
+        if not api_key:
+            logging.error("Brave Search API Key is required but not provided.")
+            return 400, {'error': 'Brave Search API Key is required', 'search_summary': 'Error: API Key missing. Please configure the plugin.'}
+        if not data.get('q'):
+            logging.error("Search query is required but not provided.")
+            return 400, {'error': 'Search query is required', 'search_summary': 'Error: Search query missing.'}
+
+        params = brave_search.build_brave_params(data)
+        cache_key = make_cache_key(params, api_key)
+        # The cache may be sqlite, shared with other workers; it is read off the event loop.
+        summary = await asyncio.to_thread(brave_search.cached_brave_summary, api_key, params, cache_key)
+        stream = str(data.get('stream', False)).lower() == 'true'
+        if summary is None:
+            try:
+                if stream:
+                    brave_data = await brave_flight.do('raw:' + cache_key, lambda: fetch_brave_data(api_key, params))
+                    return 200, brave_search.stream_brave_summary(brave_data, params, cache_key)
+                summary = await brave_flight.do(cache_key, lambda: fetch_brave_summary(api_key, params, cache_key))
+            except Exception as e:
+                summary = await asyncio.to_thread(brave_search.brave_stale_fallback, e, params, cache_key, (httpx.TransportError,))
+        return 200, {'search_summary': summary}
+
+    except Exception as e:
+        error_message, search_summary, status_code = describe_brave_error(e)
+        if isinstance(e, rate_limiter.RateLimitExceeded):
+            return status_code, {'error': error_message, 'search_summary': search_summary}, _retry_after(e)
+        return status_code, {'error': error_message, 'search_summary': search_summary}
+
+
+# --- Vectorize retrieval ----------------------------------------------------
+
+async def fetch_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, projection=None):
+    async with rate_limiter.limit_async('vectorize', access_token):
+        with metrics.stage('upstream'):
+            response = await upstream_request('vectorize', 'POST', retrieval_endpoint_url, credential=access_token,
+                                              idempotent=True, json=vectorize_payload, headers={
+                                                  'Content-Type': 'application/json',
+                                                  'Authorization': access_token
+                                              })
+    metrics.record_upstream_bytes('vectorize', len(response.content))
+    if not response.is_success:
+        return response.status_code, response.text
+    with metrics.stage('parse'):
+        if projection is not None:
+            # Projection decodes with the stdlib json object_hook, which is slow enough to stall the loop.
+            return None, await asyncio.to_thread(vectorize_query.parse_projected_results, response.content, projection)
+        return None, json_codec.loads(response.content)
+
+
+async def fetch_and_cache_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, cache_key, projection=None):
+    status_code, result = await fetch_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, projection)
+    if status_code is None:
+        await asyncio.to_thread(vectorize_query.vectorize_cache.set, cache_key, result,
+                                ttl=vectorize_query.vectorize_cache_ttl(retrieval_endpoint_url))
+    return status_code, result
+
+
+async def retrieve_vectorize(retrieval_endpoint_url, access_token, vectorize_payload, projection=None):
+    """Async counterpart of vectorize_query.retrieve_vectorize."""
+    # The key's generation and possibly the cache itself are read from sqlite, off the event loop.
+    cache_key = await asyncio.to_thread(vectorize_query.vectorize_cache_key, retrieval_endpoint_url, access_token,
+                                        vectorize_payload, projection)
+    cached_result = await asyncio.to_thread(vectorize_query.vectorize_cache.get, cache_key)
+    if cached_result is not None:
+        return None, cached_result
+
+    try:
+        status_code, result = await vectorize_flight.do(
+            cache_key,
+            lambda: fetch_and_cache_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, cache_key, projection)
+        )
+    except Exception as e:
+        stale_result = None
+        if upstream_guard.is_unavailable_error(e, (httpx.TransportError,)):
+            stale_result = await asyncio.to_thread(vectorize_query.vectorize_cache.get_stale, cache_key)
+        if stale_result is None:
+            raise
+        logging.warning(f"Vectorize endpoint unavailable ({e}). Serving stale result.")
+        return None, stale_result
+    if status_code is not None and upstream_guard.is_unavailable_status(status_code):
+        stale_result = await asyncio.to_thread(vectorize_query.vectorize_cache.get_stale, cache_key)
+        if stale_result is not None:
+            logging.warning(f"Vectorize endpoint returned {status_code}. Serving stale result.")
+            return None, stale_result
+    return status_code, result
+
+
+async def handle_vectorize_rag_retrieve(body):
+    try:
+        data = json_codec.loads(body) if body else None
+        if not data:
+            return 400, {'error': 'No JSON data provided'}
+
+        access_token, retrieval_endpoint_url, vectorize_payload, error_message = vectorize_query.parse_vectorize_request(data)
+        if not error_message:
+            projection, error_message = vectorize_query.parse_vectorize_projection(data)
+        if error_message:
+            return 400, {'error': error_message}
+
+        status_code, result = await retrieve_vectorize(retrieval_endpoint_url, access_token, vectorize_payload, projection)
+        if status_code is not None:
+            return status_code, {"error": f"Vectorize API error: {result}"}
+        if str(data.get('responseFormat', 'json')).lower() == 'text':
+            with metrics.stage('format'):
+                return 200, {'retrieval_summary': vectorize_query.format_vectorize_documents(result.get('documents'))}
+        return 200, result
+
+    except upstream_guard.CircuitOpenError as e:
+        return 503, {'error': f'Vectorize API temporarily unavailable: {str(e)}'}
+    except rate_limiter.RateLimitExceeded as e:
+        return 429, {'error': f'Vectorize API rate limit reached: {str(e)}'}, _retry_after(e)
+    except httpx.HTTPError as e:
+        return 500, {'error': f'Request error: {str(e)}'}
+    except Exception as e:
+        return 500, {'error': f'An error occurred: {str(e)}'}
+
+
+# --- DOCX generation --------------------------------------------------------
+
+async def _download_image(url, cached_content, entry, headers):
+    async with get_client().stream('GET', url, headers=headers) as response:
+        if response.status_code == 304 and cached_content is not None:
+            await asyncio.to_thread(image_fetcher.image_not_modified, url, entry)
+            return cached_content
+        response.raise_for_status()
+        image_fetcher.check_declared_size(response.headers)
+        chunks = []
+        received = 0
+        async for chunk in response.aiter_bytes(image_fetcher.CHUNK_SIZE):
+            received += len(chunk)
+            if received > image_fetcher.IMAGE_MAX_BYTES:
+                raise image_fetcher.ImageTooLarge(f"Image exceeds {image_fetcher.IMAGE_MAX_BYTES} bytes")
+            chunks.append(chunk)
+        content = b''.join(chunks)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    # Writing the blob may also trigger an eviction scan of the cache directory.
+    await asyncio.to_thread(image_fetcher.remember_image, url, content, etag, last_modified)
+    return content
+
+
+async def fetch_image(url):
+    # Reads the cached image, up to IMAGE_MAX_BYTES, from disk.
+    cached_content, entry, headers = await asyncio.to_thread(image_fetcher.begin_image_fetch, url)
+    if headers is None:
+        return cached_content
+    headers['User-Agent'] = f"Docx_Generator_bot/1.0 httpx/{httpx.__version__}"
+    return await asyncio.wait_for(_download_image(url, cached_content, entry, headers), image_fetcher.IMAGE_FETCH_TIMEOUT)
+
+
+async def fetch_images(urls):
+    """Async counterpart of image_fetcher.fetch_images."""
+    unique_urls = list(dict.fromkeys(urls))
+    semaphore = asyncio.Semaphore(image_fetcher.IMAGE_FETCH_CONCURRENCY)
+
+    async def fetch(url):
+        async with semaphore:
+            try:
+                return await fetch_image(url)
+            except Exception as e:
+                return e
+
+    results = await asyncio.gather(*(fetch(url) for url in unique_urls))
+    return dict(zip(unique_urls, results))
+
+
+def render_docx(data, prefetched_images, inline):
+    # Runs in docx_executor.
+    from docx_renderer import build_document
+    document = build_document(data, prefetched_images)
+    if inline:
+        buffer = io.BytesIO()
+        with metrics.stage('save'):
+            document.save(buffer)
+        return buffer.getvalue()
+    return generate_docx.store_document(document)
+
+
+async def handle_generate_docx(data, base_url):
+    try:
+        if len(data.get('content', [])) > generate_docx.DOCX_MAX_CONTENT_ITEMS:
+            raise generate_docx.TooManyContentItems(f"At most {generate_docx.DOCX_MAX_CONTENT_ITEMS} content items are allowed.")
+
+        from docx_renderer import image_urls
+        with metrics.stage('images'):
+            prefetched_images = await fetch_images(image_urls(data.get('content', [])))
+        inline = str(data.get('downloadMode', "link")).lower() == "inline"
+        # Run in a copy of this request's context so the render/save stages are attributed to it.
+        result = await asyncio.get_running_loop().run_in_executor(
+            docx_executor, contextvars.copy_context().run, render_docx, data, prefetched_images, inline)
+        if inline:
+            return 200, result
+        return 200, {'download_link': f"{base_url}/download/{result}"}
+
+    except generate_docx.TooManyContentItems as e:
+        return 413, {'error': str(e)}
+    except Exception as e:
+        return 500, {'error': str(e)}
+
+
+# --- ASGI plumbing ----------------------------------------------------------
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def read_body(receive):
+    chunks = []
+    received = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        received += len(chunk)
+        if MAX_CONTENT_LENGTH is not None and received > MAX_CONTENT_LENGTH:
+            raise RequestTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+def replay_body(body, receive):
+    """Return a receive callable that yields ``body`` once and then defers to ``receive``."""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+    return replay
+
+
+async def send_response(send, status, payload, headers=()):
+    """Send ``payload``: raw bytes, an iterator of JSON body pieces (streamed), or a value to encode as JSON."""
+    if hasattr(payload, '__next__'):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*'), *headers],
+        })
+        # Pieces are produced off the event loop: formatting is CPU work, and the
+        # last step writes the result to the cache.
+        while (piece := await asyncio.to_thread(next, payload, None)) is not None:
+            await send({'type': 'http.response.body', 'body': piece, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if isinstance(payload, bytes):
+        body = payload
+    else:
+        # Same encoding as Flask's jsonify with FastJSONProvider.
+        body = json_codec.dumps(payload, sort_keys=True) + b'\n'
+        headers = [(b'content-type', b'application/json'), *headers]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-length', str(len(body)).encode('latin-1')),
+            (b'access-control-allow-origin', b'*'),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_clients()
+            docx_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+NATIVE_JSON_ROUTES = {
+    '/brave_search': handle_brave_search,
+    '/vectorize-rag-retrieve': handle_vectorize_rag_retrieve,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    path = scope.get('path')
+    native = scope['type'] == 'http' and scope['method'] == 'POST' and (
+        path in NATIVE_JSON_ROUTES or
+        (path == '/generate_docx' and not _header(scope, b'content-type').startswith('application/x-ndjson')))
+    if not native:
+        await wsgi_application(scope, receive, send)
+        return
+
+    metrics_token = metrics.start_request(path)
+
+    async def respond(status, payload, headers=()):
+        server_timing = metrics.finish_request(metrics_token, 'POST', status)
+        if server_timing:
+            headers = [*headers, (b'server-timing', server_timing.encode('latin-1'))]
+        await send_response(send, status, payload, headers)
+
+    try:
+        body = await read_body(receive)
+    except RequestTooLarge:
+        await respond(413, {'error': f'Request bodies are limited to {MAX_CONTENT_LENGTH} bytes.'})
+        return
+
+    if path in NATIVE_JSON_ROUTES:
+        # Handlers return (status, payload) or (status, payload, headers).
+        await respond(*await NATIVE_JSON_ROUTES[path](body))
+        return
+
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not data:
+        await respond(400, {'error': 'Invalid input. Must provide document parameters.'})
+        return
+    if str(data.get('asyncMode', "false")).lower() == "true":
+        # Job submission is cheap and already off the request thread; let Flask handle it.
+        metrics.discard_request(metrics_token)
+        await wsgi_application(scope, replay_body(body, receive), send)
+        return
+
+    server = scope.get('server') or ('localhost', 80)
+    host = _header(scope, b'host') or f"{server[0]}:{server[1]}"
+    status, payload = await handle_generate_docx(data, f"{scope.get('scheme', 'http')}://{host}")
+    headers = ()
+    if isinstance(payload, bytes):
+        headers = [
+            (b'content-type', generate_docx.DOCX_MIMETYPE.encode('latin-1')),
+            (b'content-disposition', b'attachment; filename=generated_document.docx'),
+        ]
+    await respond(status, payload, headers)
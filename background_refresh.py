@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import registry, METRICS_ENABLED
+
+
+class BackgroundRefresher:
+    """Run refreshes of cached values on a small per-worker thread pool, off the request path.
+
+    At most ``threads`` refreshes run at once and a key is never refreshed twice
+    concurrently. Refreshes beyond that are dropped rather than queued, so a
+    backlog never builds up behind live traffic.
+    """
+
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Called with self._lock held. A forked worker starts its own pool.
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=f'{self.name}-refresh')
+            self._pid = os.getpid()
+            self._pending = set()
+        return self._executor
+
+    def _count(self, trigger, outcome):
+        if METRICS_ENABLED:
+            registry.inc('plugin_background_refresh_total', {'cache': self.name, 'trigger': trigger, 'outcome': outcome})
+
+    def _set_in_flight(self):
+        # Called with self._lock held.
+        if METRICS_ENABLED:
+            registry.set_gauge('plugin_background_refreshes_in_flight', {'cache': self.name}, len(self._pending))
+
+    def submit(self, key, fn, trigger):
+        """Run ``fn`` in the background unless ``key`` is already being refreshed or the pool is busy.
+
+        ``fn`` returns False if it decided the refresh was not needed after all.
+        Returns whether the refresh was started.
+        """
+        if self.threads <= 0:
+            return False
+        with self._lock:
+            executor = self._get_executor()
+            if key in self._pending or len(self._pending) >= self.threads:
+                busy = True
+            else:
+                busy = False
+                self._pending.add(key)
+                self._set_in_flight()
+        if busy:
+            self._count(trigger, 'dropped')
+            return False
+        executor.submit(self._run, key, fn, trigger)
+        return True
+
+    def _run(self, key, fn, trigger):
+        try:
+            outcome = 'skipped' if fn() is False else 'refreshed'
+        except Exception as e:
+            logging.warning(f"Background {self.name} refresh failed: {e}")
+            outcome = 'failed'
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+                self._set_in_flight()
+        self._count(trigger, outcome)
+
+
+class PopularityTracker:
+    """Count recent lookups per key, with the arguments needed to refresh each one.
+
+    Counts halve every ``half_life`` seconds, so the ranking follows what has been
+    asked for lately. The arguments are only ever held in this worker's memory.
+    """
+
+    def __init__(self, max_keys, half_life):
+        self.max_keys = max_keys
+        self.half_life = half_life
+        self._entries = {}
+        self._last_decay = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, key, refresh_args):
+        with self._lock:
+            entry = self._entries.get(key)
+            self._entries[key] = (entry[0] + 1 if entry is not None else 1, refresh_args)
+            if len(self._entries) > 2 * self.max_keys:
+                self._trim()
+
+    def _trim(self):
+        # Called with self._lock held.
+        ranked = sorted(self._entries.items(), key=lambda item: item[1][0], reverse=True)
+        self._entries = dict(ranked[:self.max_keys])
+
+    def decay(self):
+        now = time.monotonic()
+        with self._lock:
+            factor = 0.5 ** ((now - self._last_decay) / self.half_life)
+            self._last_decay = now
+            # A key asked for once is forgotten after about one half-life.
+            self._entries = {key: (count * factor, args) for key, (count, args) in self._entries.items()
+                             if count * factor >= 0.5}
+
+    def top(self, n, min_count=0):
+        """The ``n`` most requested keys with at least ``min_count`` recent lookups, as ``[(key, refresh_args), ...]``."""
+        with self._lock:
+            ranked = sorted(self._entries.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, args) for key, (count, args) in ranked[:n] if count >= min_count]
+
+
+class PrefetchScheduler:
+    """Every ``interval`` seconds, call ``tick`` from a daemon thread of the current worker."""
+
+    def __init__(self, name, interval, tick):
+        self.name = name
+        self.interval = interval
+        self.tick = tick
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name=f'{self.name}-prefetch', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                logging.warning(f"{self.name} prefetch failed: {e}")
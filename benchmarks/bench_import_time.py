@@ -0,0 +1,90 @@
+"""Measure how long a worker takes to import the app, using ``python -X importtime``.
+
+Usage: python benchmarks/bench_import_time.py [--module main_app] [--runs 5] [--top 15]
+           [--forbid docx,lxml,PIL] [--baseline previous.json] [--tolerance 0.2] [--output results.json]
+
+Each run imports --module in a fresh interpreter. The report has the median
+total import time, the slowest modules, and whether any --forbid module was
+imported. These are libraries that should only load on first use.
+Exits with status 1 if a forbidden module was imported. It also exits with 1
+if the median total is more than --tolerance slower than a --baseline report.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(module):
+    """Return ``{module_name: (self_us, cumulative_us)}`` for one fresh import of ``module``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='main_app')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--forbid', default='docx,lxml,PIL',
+                        help='Comma-separated packages that must not be imported by --module.')
+    parser.add_argument('--baseline', help='A previous report to compare the total import time against.')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    profiles = [import_profile(args.module) for _ in range(args.runs)]
+    totals = [profile[args.module][1] for profile in profiles]
+    last = profiles[-1]
+    slowest = sorted(last.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    forbidden = [package for package in filter(None, args.forbid.split(','))
+                 if any(name == package or name.startswith(package + '.') for name in last)]
+
+    report = {
+        'benchmark': 'import_time',
+        'module': args.module,
+        'runs': args.runs,
+        'total_ms': round(statistics.median(totals) / 1000, 1),
+        'modules_imported': len(last),
+        'forbidden_imported': forbidden,
+        'slowest': [{'module': name, 'self_ms': round(self_us / 1000, 1), 'cumulative_ms': round(cumulative_us / 1000, 1)}
+                    for name, (self_us, cumulative_us) in slowest],
+    }
+
+    print(f"import {args.module}: {report['total_ms']} ms (median of {args.runs}), {len(last)} modules")
+    for entry in report['slowest']:
+        print(f"  {entry['cumulative_ms']:>8.1f} ms  {entry['module']}")
+
+    failures = []
+    if forbidden:
+        failures.append(f"forbidden modules imported: {', '.join(forbidden)}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['baseline_total_ms'] = baseline['total_ms']
+        if report['total_ms'] > baseline['total_ms'] * (1 + args.tolerance):
+            failures.append(f"import time {report['total_ms']} ms exceeds baseline {baseline['total_ms']} ms "
+                            f"by more than {args.tolerance:.0%}")
+    report['failures'] = failures
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
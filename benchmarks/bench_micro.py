@@ -0,0 +1,117 @@
+"""Micro-benchmarks for the CPU-bound parts of the plugins on synthetic large inputs.
+
+Usage: python benchmarks/bench_micro.py [--repeat 5] [--brave-results 200] [--paragraphs 2000]
+           [--table-rows 1000] [--table-cols 10] [--output results.json]
+
+Times format_brave_response_comprehensive, process_paragraph and
+process_table and reports the best, median and mean of --repeat runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import docx_renderer
+from brave_search import format_brave_response_comprehensive
+from docx import Document
+from docx_formatting import DocumentFormatter
+from fake_upstreams import brave_payload
+
+
+def bench_brave_format(args):
+    brave_data = brave_payload(args.brave_results)
+
+    def run():
+        format_brave_response_comprehensive(brave_data)
+    return run
+
+
+def bench_paragraphs(args):
+    items = [{
+        'type': 'paragraph',
+        'text': f'Paragraph {i}. ' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 4,
+        'paragraph_format': {'space_after': 6, 'alignment': 'JUSTIFY', 'first_line_indent': 0.25},
+        'runs': [{'text': ' Bold tail.', 'bold': True, 'font': {'name': 'Calibri', 'size': 11, 'color': '#333333'}}],
+    } for i in range(args.paragraphs)]
+
+    def run():
+        document = Document()
+        formatter = DocumentFormatter(document)
+        for item in items:
+            docx_renderer.process_paragraph(document, item, formatter=formatter)
+    return run
+
+
+def bench_table(args):
+    item = {
+        'type': 'table',
+        'rows': args.table_rows,
+        'cols': args.table_cols,
+        'style': 'Table Grid',
+        'data': [[f'r{row}c{col}' for col in range(args.table_cols)] for row in range(args.table_rows)],
+    }
+
+    def run():
+        docx_renderer.process_table(Document(), item)
+    return run
+
+
+BENCHMARKS = {
+    'format_brave_response_comprehensive': (bench_brave_format, lambda args: {'results': args.brave_results}),
+    'process_paragraph': (bench_paragraphs, lambda args: {'paragraphs': args.paragraphs}),
+    'process_table': (bench_table, lambda args: {'rows': args.table_rows, 'cols': args.table_cols}),
+}
+
+
+def time_runs(run, repeat):
+    run()  # warm-up: imports, compiled format appliers, template cache
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='Comma-separated subset of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--brave-results', type=int, default=200)
+    parser.add_argument('--paragraphs', type=int, default=2000)
+    parser.add_argument('--table-rows', type=int, default=1000)
+    parser.add_argument('--table-cols', type=int, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = []
+    for name in names:
+        setup, describe = BENCHMARKS[name]
+        run = setup(args)
+        timings = time_runs(run, args.repeat)
+        results.append({
+            'name': name,
+            'input': describe(args),
+            'repeat': args.repeat,
+            'best_seconds': round(min(timings), 5),
+            'median_seconds': round(statistics.median(timings), 5),
+            'mean_seconds': round(statistics.mean(timings), 5),
+        })
+        print(f"{name:>38}: best {min(timings):8.4f}s  median {statistics.median(timings):8.4f}s")
+
+    report = {'benchmark': 'micro', 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Time process_table for growing row counts, cell by cell versus the bulk fill path.
+
+Usage: python benchmarks/bench_table_fill.py [--rows 25,50,100,200,500,1000,2000] [--cols 10] [--output results.json]
+
+The cell-by-cell path grows quadratically, so it is only timed up to
+--max-per-cell-rows rows.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import docx_renderer
+from docx import Document
+
+
+def time_table(rows, cols, bulk):
+    item = {
+        'type': 'table',
+        'rows': rows,
+        'cols': cols,
+        'style': 'Table Grid',
+        'vertical_alignment': 'CENTER',
+        'data': [[f"r{row_idx}c{col_idx}" for col_idx in range(cols)] for row_idx in range(rows)],
+    }
+    docx_renderer.DOCX_BULK_TABLE_MIN_CELLS = 0 if bulk else float('inf')
+    document = Document()
+    start = time.perf_counter()
+    docx_renderer.process_table(document, item)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='25,50,100,200,500,1000,2000')
+    parser.add_argument('--cols', type=int, default=10)
+    parser.add_argument('--max-per-cell-rows', type=int, default=100)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = []
+    for rows in [int(value) for value in args.rows.split(',')]:
+        per_cell = time_table(rows, args.cols, bulk=False) if rows <= args.max_per_cell_rows else None
+        bulk = time_table(rows, args.cols, bulk=True)
+        results.append({
+            'rows': rows,
+            'cols': args.cols,
+            'per_cell_seconds': round(per_cell, 4) if per_cell is not None else None,
+            'bulk_seconds': round(bulk, 4),
+            'speedup': round(per_cell / bulk, 1) if per_cell is not None and bulk else None,
+        })
+        per_cell_text = f"{per_cell:8.3f}s" if per_cell is not None else '  skipped'
+        print(f"{rows:>6} rows x {args.cols} cols: per-cell {per_cell_text}  bulk {bulk:8.3f}s")
+
+    report = {'benchmark': 'table_fill', 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Local stand-ins for the Brave Search API, a Vectorize retrieval endpoint and an image host.
+
+Usage: python benchmarks/fake_upstreams.py [--port 8900] [--latency-ms 100] [--results 20] [--error-rate 0]
+
+Routes:
+  GET  /res/v1/web/search   Brave-shaped JSON with --results web/news/video results
+  POST /retrieve            Vectorize-shaped JSON with --results documents
+  GET  /images/<name>.png   A PNG of roughly --image-kb kilobytes
+
+Each request sleeps --latency-ms (plus up to --jitter-ms) and fails with a 503
+with probability --error-rate. Point the server at it with
+BRAVE_API_URL=http://127.0.0.1:<port>/res/v1/web/search.
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+class UpstreamConfig:
+    def __init__(self, latency_ms=100, jitter_ms=0, results=20, error_rate=0.0, image_kb=50):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.results = results
+        self.error_rate = error_rate
+        self.image_kb = image_kb
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.brave_body = json.dumps(brave_payload(results)).encode('utf-8')
+        self.vectorize_body = json.dumps(vectorize_payload(results)).encode('utf-8')
+        self.image_body = png_payload(image_kb)
+
+
+def brave_payload(results):
+    return {
+        'mixed': {'type': 'summary', 'summary': {'text': 'A synthetic summary of the search results.'}},
+        'web': {'results': [{
+            'title': f'Web result {i}',
+            'url': f'https://example.com/page/{i}',
+            'description': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3,
+        } for i in range(results)]},
+        'news': {'results': [{
+            'title': f'News story {i}',
+            'url': f'https://news.example.com/story/{i}',
+            'description': 'Sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.',
+            'meta_url': {'hostname': 'news.example.com'},
+            'age': '2 hours ago',
+        } for i in range(results // 2)]},
+        'videos': {'results': [{
+            'title': f'Video {i}',
+            'url': f'https://video.example.com/watch/{i}',
+            'description': 'Ut enim ad minim veniam.',
+            'video': {'duration': '03:21', 'creator': 'Example Channel'},
+        } for i in range(results // 4)]},
+    }
+
+
+def vectorize_payload(results):
+    return {'documents': [{
+        'id': f'doc-{i}',
+        'text': 'Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore. ' * 8,
+        'similarity': round(1 - i / (results + 1), 4),
+        'source': f'document-{i % 7}.pdf',
+        'source_display_name': f'Document {i % 7}',
+        'chunk_id': str(i),
+    } for i in range(results)]}
+
+
+def png_payload(kilobytes):
+    # Random pixels do not compress, so the PNG size tracks the pixel count.
+    side = max(1, int((kilobytes * 1024 / 3) ** 0.5))
+    image = Image.frombytes('RGB', (side, side), random.Random(0).randbytes(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_handler(config):
+    class FakeUpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _respond(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _simulate(self):
+            with config.lock:
+                config.requests += 1
+            time.sleep((config.latency_ms + random.uniform(0, config.jitter_ms)) / 1000)
+            if config.error_rate and random.random() < config.error_rate:
+                self._respond(503, b'{"message": "Simulated upstream failure"}', 'application/json')
+                return False
+            return True
+
+        def do_GET(self):
+            if self.path.startswith('/res/v1/web/search'):
+                if self._simulate():
+                    self._respond(200, config.brave_body, 'application/json')
+            elif self.path.startswith('/images/'):
+                if self._simulate():
+                    self._respond(200, config.image_body, 'image/png')
+            else:
+                self._respond(404, b'{}', 'application/json')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.startswith('/retrieve'):
+                if self._simulate():
+                    self._respond(200, config.vectorize_body, 'application/json')
+            else:
+                self._respond(404, b'{}', 'application/json')
+
+    return FakeUpstreamHandler
+
+
+def start_fake_upstreams(config, host='127.0.0.1', port=0):
+    """Serve ``config`` on a background thread. Returns the server; its base URL is ``server.url``."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    server.url = f'http://{host}:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_upstream_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=100)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--results', type=int, default=20, help='Results per Brave/Vectorize response.')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--image-kb', type=int, default=50)
+
+
+def config_from_arguments(args):
+    return UpstreamConfig(args.latency_ms, args.jitter_ms, args.results, args.error_rate, args.image_kb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_fake_upstreams(config_from_arguments(args), port=args.port)
+    print(f"Fake upstreams listening on {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""Drive the plugin endpoints at increasing concurrency against local fake upstreams.
+
+Usage: python benchmarks/load_test.py [--server gunicorn|uvicorn|flask] [--workers 2] [--threads 4]
+           [--endpoints brave,vectorize,docx] [--concurrency 1,8,32] [--requests 200]
+           [--latency-ms 100] [--results 20] [--error-rate 0] [--output results.json]
+
+Starts benchmarks/fake_upstreams.py in-process, launches the server with
+BRAVE_API_URL pointing at it (or uses --url for a server that is already
+running) and reports p50/p95/p99 latency, throughput and the server's
+resident memory for every endpoint and concurrency level. Response caches
+are disabled unless --cache is given, so every request reaches the upstream.
+"""
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_upstreams import add_upstream_arguments, config_from_arguments, start_fake_upstreams
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_command(args, port):
+    if args.server == 'gunicorn':
+        # Worker and thread counts not given on the command line come from gunicorn.conf.py.
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application',
+                   '--bind', f'127.0.0.1:{port}']
+        if args.workers:
+            command += ['--workers', str(args.workers)]
+        if args.threads:
+            command += ['--threads', str(args.threads)]
+        return command
+    if args.server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                '--port', str(port), '--workers', str(args.workers or 2), '--log-level', 'warning']
+    return [sys.executable, '-m', 'flask', '--app', 'main_app', 'run', '--port', str(port), '--with-threads']
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of ``pid`` and all its descendants (Linux only, else None)."""
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, so split after its closing paren.
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.pid is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self.interval)
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return None
+        mb = 1024 * 1024
+        return {'start': round(self.samples[0] / mb, 1), 'peak': round(max(self.samples) / mb, 1),
+                'end': round(self.samples[-1] / mb, 1)}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile.
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def build_request(endpoint, index, upstream_url, args):
+    query = 'benchmark query' if args.repeat_queries else f'benchmark query {index}'
+    if endpoint == 'brave':
+        return '/brave_search', {'braveSearchAPIKey': 'benchmark-key', 'q': query, 'count': args.results}
+    if endpoint == 'vectorize':
+        return '/vectorize-rag-retrieve', {'accessToken': 'benchmark-token', 'question': query,
+                                           'retrievalEndpointURL': f'{upstream_url}/retrieve',
+                                           'numResults': args.results}
+    content = [{'type': 'heading', 'text': f'Benchmark document {index}', 'level': 1}]
+    for paragraph_idx in range(args.paragraphs):
+        content.append({'type': 'paragraph', 'text': f'Paragraph {paragraph_idx}. ' + 'Lorem ipsum dolor sit amet. ' * 10,
+                        'paragraph_format': {'space_after': 6, 'alignment': 'JUSTIFY'},
+                        'runs': [{'text': ' Consectetur adipiscing elit.', 'bold': True,
+                                  'font': {'name': 'Calibri', 'size': 11}}]})
+    content.append({'type': 'table', 'rows': args.table_rows, 'cols': 5, 'style': 'Table Grid',
+                    'data': [[f'r{row}c{col}' for col in range(5)] for row in range(args.table_rows)]})
+    image_key = 'shared' if args.repeat_queries else index
+    for image_idx in range(args.images):
+        content.append({'type': 'image', 'url': f'{upstream_url}/images/{image_key}-{image_idx}.png', 'width': 2})
+    return '/generate_docx', {'content': content}
+
+
+def run_level(base_url, endpoint, concurrency, args, upstream_url, server_pid):
+    local = threading.local()
+    latencies = []
+    status_counts = {}
+    lock = threading.Lock()
+
+    def one(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        path, payload = build_request(endpoint, index, upstream_url, args)
+        start = time.perf_counter()
+        try:
+            status = session.post(base_url + path, json=payload, timeout=args.timeout).status_code
+        except requests.exceptions.RequestException:
+            status = 'exception'
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+
+    with RssSampler(server_pid) as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, range(args.requests)))
+        wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': args.requests,
+        'errors': sum(count for status, count in status_counts.items() if status != '200'),
+        'status_counts': status_counts,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(args.requests / wall, 2) if wall else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+            'p50': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round(latencies[-1] * 1000, 2),
+        },
+        'server_rss_mb': sampler.summary(),
+    }
+
+
+def wait_until_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Server exited with status {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/brave_search/cache_stats', timeout=1).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} did not become ready within {timeout}s')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn', 'flask'], default='gunicorn')
+    parser.add_argument('--workers', type=int, help='Server workers (default: chosen by gunicorn.conf.py; 2 for uvicorn).')
+    parser.add_argument('--threads', type=int, help='Threads per gunicorn worker (default: chosen by gunicorn.conf.py).')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting one.')
+    parser.add_argument('--server-pid', type=int, help='Process to measure RSS of when --url is used.')
+    parser.add_argument('--endpoints', default='brave,vectorize,docx')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and concurrency level.')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--cache', action='store_true', help='Leave the response and image caches enabled.')
+    parser.add_argument('--repeat-queries', action='store_true',
+                        help='Send the same query/images every time (exercises caching and coalescing).')
+    parser.add_argument('--paragraphs', type=int, default=50)
+    parser.add_argument('--table-rows', type=int, default=20)
+    parser.add_argument('--images', type=int, default=2)
+    parser.add_argument('--upstream-port', type=int, default=0)
+    parser.add_argument('--output')
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    upstream_config = config_from_arguments(args)
+    upstream = start_fake_upstreams(upstream_config, port=args.upstream_port)
+
+    process = None
+    workdir = tempfile.mkdtemp(prefix='plugin_server_bench_')
+    if args.url:
+        base_url = args.url.rstrip('/')
+        server_pid = args.server_pid
+    else:
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        env = dict(os.environ)
+        env.update({
+            'BRAVE_API_URL': f'{upstream.url}/res/v1/web/search',
+            'ARTIFACT_DIR': os.path.join(workdir, 'artifacts'),
+            'ARTIFACT_INDEX_PATH': os.path.join(workdir, 'artifacts.sqlite3'),
+            'IMAGE_CACHE_DIR': os.path.join(workdir, 'images'),
+            # Every simulated request uses one credential; per-key limits would measure the limiter, not the server.
+            'RATE_LIMIT_ENABLED': 'false',
+        })
+        if not args.cache:
+            env.update({'BRAVE_CACHE_ENABLED': 'false', 'VECTORIZE_CACHE_ENABLED': 'false', 'IMAGE_CACHE_ENABLED': 'false'})
+        process = subprocess.Popen(server_command(args, port), cwd=REPO_ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = process.pid
+
+    results = []
+    try:
+        wait_until_ready(base_url, process)
+        for endpoint in args.endpoints.split(','):
+            for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                result = run_level(base_url, endpoint, concurrency, args, upstream.url, server_pid)
+                results.append(result)
+                latency = result['latency_ms']
+                rss = result['server_rss_mb']
+                print(f"{endpoint:>9} c={concurrency:<4} {result['throughput_rps']:>8.1f} req/s  "
+                      f"p50 {latency['p50']:>8.1f}ms  p95 {latency['p95']:>8.1f}ms  p99 {latency['p99']:>8.1f}ms  "
+                      f"errors {result['errors']:<4} rss peak {rss['peak'] if rss else '-'} MB")
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        upstream.shutdown()
+
+    report = {
+        'benchmark': 'load',
+        'revision': git_revision(),
+        'server': None if args.url else {'kind': args.server, 'workers': args.workers, 'threads': args.threads},
+        'upstream': {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, 'results': args.results,
+                     'error_rate': args.error_rate, 'image_kb': args.image_kb,
+                     'requests_served': upstream_config.requests},
+        'cache': args.cache,
+        'repeat_queries': args.repeat_queries,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,76 @@
-from flask import Flask, request, jsonify, make_response, Blueprint
+from flask import Flask, Response, request, jsonify, make_response, Blueprint
 from flask_cors import CORS
 import requests
 from dotenv import load_dotenv
 import logging # Import the logging module
+import contextvars
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from response_cache import create_cache, hash_credential, make_cache_key
+import json_codec
+import upstream_client
+from upstream_guard import CircuitOpenError, is_unavailable_error
+from rate_limiter import RateLimitExceeded, limit as rate_limit
+from single_flight import SingleFlight
+from background_refresh import BackgroundRefresher, PopularityTracker, PrefetchScheduler
+from metrics import record_upstream_bytes, stage
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
 
+BRAVE_API_URL = os.environ.get('BRAVE_API_URL', 'https://api.search.brave.com/res/v1/web/search')
+
 brave_search_bp = Blueprint('brave_search', __name__)
 CORS(brave_search_bp, resources={r"/brave_search": {"origins": "*"}})
 
+# Formatted search summaries are cached per normalized query and API key. Results
+# for time-restricted queries go stale faster, so each freshness window gets its own TTL.
+# Expired summaries are kept for BRAVE_CACHE_STALE_TTL more seconds and served when
+# the Brave API is unavailable.
+brave_cache = create_cache('BRAVE', default_ttl=900, max_entries=1024, stale_ttl=3600)
+BRAVE_CACHE_TTLS = {
+    'pd': float(os.environ.get('BRAVE_CACHE_TTL_PD', 300)),
+    'pw': float(os.environ.get('BRAVE_CACHE_TTL_PW', 1800)),
+    'pm': float(os.environ.get('BRAVE_CACHE_TTL_PM', 3600)),
+    'py': float(os.environ.get('BRAVE_CACHE_TTL_PY', 21600)),
+}
+brave_flight = SingleFlight()
+
+# Stale-while-revalidate: a summary that expired less than BRAVE_SWR_WINDOW seconds
+# ago is answered immediately while a background thread fetches a new one. The
+# window is at most BRAVE_SWR_MAX_TTL_FRACTION of the summary's TTL, so short-lived
+# (freshness-restricted) results are never served much older than intended.
+# Prefetch: every BRAVE_PREFETCH_INTERVAL seconds, the worker's BRAVE_PREFETCH_TOP_N
+# most repeated time-sensitive searches (freshness set, or news results) are
+# refreshed when they expire within BRAVE_PREFETCH_LEAD seconds. Background fetches
+# run on BRAVE_REFRESH_THREADS threads and never wait for, or use up the last of,
+# an API key's rate limit.
+BRAVE_SWR_ENABLED = os.environ.get('BRAVE_SWR_ENABLED', 'true').lower() == 'true'
+BRAVE_SWR_WINDOW = float(os.environ.get('BRAVE_SWR_WINDOW', 600))
+BRAVE_SWR_MAX_TTL_FRACTION = float(os.environ.get('BRAVE_SWR_MAX_TTL_FRACTION', 0.5))
+BRAVE_REFRESH_THREADS = int(os.environ.get('BRAVE_REFRESH_THREADS', 2))
+BRAVE_PREFETCH_ENABLED = os.environ.get('BRAVE_PREFETCH_ENABLED', 'true').lower() == 'true'
+BRAVE_PREFETCH_TOP_N = int(os.environ.get('BRAVE_PREFETCH_TOP_N', 20))
+BRAVE_PREFETCH_MIN_HITS = float(os.environ.get('BRAVE_PREFETCH_MIN_HITS', 3))
+BRAVE_PREFETCH_INTERVAL = float(os.environ.get('BRAVE_PREFETCH_INTERVAL', 30))
+BRAVE_PREFETCH_LEAD = float(os.environ.get('BRAVE_PREFETCH_LEAD', 60))
+BRAVE_PREFETCH_HALF_LIFE = float(os.environ.get('BRAVE_PREFETCH_HALF_LIFE', 600))
+brave_refresher = BackgroundRefresher('brave', BRAVE_REFRESH_THREADS)
+brave_popularity = PopularityTracker(max_keys=256, half_life=BRAVE_PREFETCH_HALF_LIFE)
+
+# /brave_search/batch fans queries out concurrently, but never runs more than
+# BRAVE_BATCH_PER_KEY_CONCURRENCY upstream calls at once for a single API key.
+# A key's semaphore only lives while one of its batches is running.
+# Merged summaries are cached like single ones, for the shortest TTL of their queries.
+BRAVE_BATCH_MAX_QUERIES = int(os.environ.get('BRAVE_BATCH_MAX_QUERIES', 10))
+BRAVE_BATCH_PER_KEY_CONCURRENCY = int(os.environ.get('BRAVE_BATCH_PER_KEY_CONCURRENCY', 4))
+_batch_semaphores = weakref.WeakValueDictionary()
+_batch_semaphores_lock = threading.Lock()
+
 def _format_web_results(results_data):
     if not results_data: return ""
     formatted_items = []
@@ -76,12 +136,21 @@ def _format_location_results(results_data):
     if not formatted_items: return ""
     return "Locations:\n" + "\n\n".join(formatted_items)
 
-def format_brave_response_comprehensive(brave_data):
-    if not brave_data or not isinstance(brave_data, dict):
-        logging.warning("Format_brave_response_comprehensive: No data or unexpected data format received.")
-        return "No data received or data in unexpected format from Brave Search."
+SECTION_SEPARATOR = "\n\n===\n\n"
+
+def iter_brave_response_sections(brave_data):
+    """Yield the non-empty formatted sections of ``brave_data``, summary first, each formatted only when requested."""
+    summary_text = ""
+    if 'mixed' in brave_data and brave_data['mixed'].get('type') == 'summary':
+        summary_text = brave_data['mixed'].get('summary', {}).get('text', '')
+    elif 'infobox' in brave_data and brave_data['infobox'].get('results'):
+        if brave_data['infobox']['results']:
+            infobox_result = brave_data['infobox']['results'][0]
+            summary_text = infobox_result.get('description', infobox_result.get('long_snippet', ''))
+
+    if summary_text:
+        yield f"Summary from Brave Search:\n  {summary_text.strip()}"
 
-    all_formatted_sections = []
     result_type_map = {
         'web': _format_web_results,
         'news': _format_news_results,
@@ -93,27 +162,304 @@ def format_brave_response_comprehensive(brave_data):
     for key_in_json, formatter_func in result_type_map.items():
         if key_in_json in brave_data and brave_data[key_in_json].get('results'):
             formatted_section = formatter_func(brave_data[key_in_json]['results'])
-            if formatted_section:
-                all_formatted_sections.append(formatted_section)
-    
-    summary_text = ""
-    if 'mixed' in brave_data and brave_data['mixed'].get('type') == 'summary':
-        summary_text = brave_data['mixed'].get('summary', {}).get('text', '')
-    elif 'infobox' in brave_data and brave_data['infobox'].get('results'):
-        if brave_data['infobox']['results']:
-            infobox_result = brave_data['infobox']['results'][0]
-            summary_text = infobox_result.get('description', infobox_result.get('long_snippet', ''))
+            if formatted_section and formatted_section.strip():
+                yield formatted_section
 
-    if summary_text:
-        all_formatted_sections.insert(0, f"Summary from Brave Search:\n  {summary_text.strip()}")
+def format_brave_response_comprehensive(brave_data):
+    if not brave_data or not isinstance(brave_data, dict):
+        logging.warning("Format_brave_response_comprehensive: No data or unexpected data format received.")
+        return "No data received or data in unexpected format from Brave Search."
 
-    all_formatted_sections = [section for section in all_formatted_sections if section and section.strip()]
+    all_formatted_sections = list(iter_brave_response_sections(brave_data))
 
     if not all_formatted_sections:
         logging.info("Format_brave_response_comprehensive: No relevant search results found or results could not be parsed.")
         return "No relevant search results found or results could not be parsed."
         
-    return "\n\n===\n\n".join(all_formatted_sections)
+    return SECTION_SEPARATOR.join(all_formatted_sections)
+
+def stream_brave_summary(brave_data, params, cache_key):
+    """Yield the ``{"search_summary": ...}`` body as bytes, one section at a time.
+
+    Clients parse the same JSON as from the buffered response. The sections are
+    kept and joined once the last one has been sent, to be cached, so this only
+    saves the JSON-encoded copy of the summary.
+    """
+    yield b'{"search_summary":"'
+    sections = []
+    if brave_data and isinstance(brave_data, dict):
+        for section in iter_brave_response_sections(brave_data):
+            yield json_codec.escape_string(SECTION_SEPARATOR + section if sections else section)
+            sections.append(section)
+    if sections:
+        summary = SECTION_SEPARATOR.join(sections)
+    else:
+        summary = format_brave_response_comprehensive(brave_data)
+        yield json_codec.escape_string(summary)
+    yield b'"}\n'
+    brave_cache.set(cache_key, summary, ttl=brave_cache_ttl(params))
+
+def is_valid_param(param_value, param_name_for_log="parameter"): # Added param_name_for_log for better logging
+    if param_value is None:
+        return False
+    s_value = str(param_value).strip()
+    if not s_value:
+        return False
+    lower_s_value = s_value.lower()
+    if lower_s_value == "undefined" or lower_s_value == "null":
+        return False
+    if s_value.startswith("{") and s_value.endswith("}"):
+        logging.info(f"Parameter '{param_name_for_log}' value ('{s_value}') looks like an unsubstituted placeholder. Treating as invalid.")
+        return False
+    return True
+
+def build_brave_params(data):
+    params = {'q': data.get('q')}
+    param_mapping = {
+        'offset': data.get('offset'),
+        'freshness': data.get('freshness'),
+        'result_filter': data.get('result_filter'),
+        'country': data.get('country'),
+        'search_lang': data.get('searchLang'),
+        'count': data.get('count'),
+        'safesearch': data.get('safesearch'),
+        'goggles_id': data.get('gogglesId'),
+        'units': data.get('units')
+    }
+
+    for api_param, value in param_mapping.items():
+        if is_valid_param(value, api_param): # Pass api_param for logging context
+            if api_param in ['count', 'offset']:
+                try:
+                    num_value = int(str(value))
+                    if api_param == 'offset':
+                        if num_value >= 0: params[api_param] = num_value
+                    elif api_param == 'count': 
+                        if num_value > 0: params[api_param] = min(num_value, 20) 
+                except (ValueError, TypeError):
+                    logging.warning(f"Could not convert {api_param} ('{value}') to int. Skipping.")
+                    continue
+            else:
+                params[api_param] = value
+    
+    if 'count' not in params:
+        params['count'] = 10
+        logging.debug("Parameter 'count' not provided or invalid, defaulting to 10.")
+    return params
+
+def brave_cache_ttl(params):
+    freshness = str(params.get('freshness', '')).lower()
+    return BRAVE_CACHE_TTLS.get(freshness, brave_cache.default_ttl)
+
+def brave_request_headers(api_key):
+    return {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'X-Subscription-Token': api_key,
+    }
+
+def fetch_brave_data(api_key, params, background=False):
+    headers = brave_request_headers(api_key)
+
+    logging.info(f"Requesting Brave API. Query: '{params['q']}', Params: {params}")
+    
+    # Background refreshes give up at once, rather than queue, when live searches need the key's capacity.
+    limit_options = {'max_wait': 0, 'reserve': 1} if background else {}
+    with rate_limit('brave', api_key, **limit_options), stage('upstream'):
+        api_response = upstream_client.guarded_request('brave', 'GET', BRAVE_API_URL, credential=api_key, params=params, headers=headers, proxies=None)
+        api_response.raise_for_status()
+    record_upstream_bytes('brave', len(api_response.content))
+    
+    # For debugging, you might want to see the raw data sometimes
+    # logging.debug(f"Raw Brave API Data: {api_response.json()}")
+    with stage('parse'):
+        return json_codec.loads(api_response.content)
+
+def fetch_brave_summary(api_key, params, cache_key, background=False):
+    brave_api_data = fetch_brave_data(api_key, params, background)
+    with stage('format'):
+        formatted_text_response = format_brave_response_comprehensive(brave_api_data)
+    brave_cache.set(cache_key, formatted_text_response, ttl=brave_cache_ttl(params))
+    return formatted_text_response
+
+def is_time_sensitive(params):
+    return bool(params.get('freshness')) or 'news' in str(params.get('result_filter', '')).lower()
+
+def refresh_brave_summary(api_key, params, cache_key, lead):
+    """Background refresh; skipped if the summary (maybe refreshed by another worker) is fresh for more than ``lead`` seconds.
+
+    Returns whether the summary was refreshed.
+    """
+    _, fresh_until = brave_cache.peek(cache_key)
+    if fresh_until is not None and fresh_until - time.time() > lead:
+        return False
+    try:
+        fetch_brave_summary(api_key, params, cache_key, background=True)
+    except RateLimitExceeded:
+        # The key's capacity is in use by live searches; the next stale hit or prefetch tries again.
+        return False
+    return True
+
+def prefetch_popular_brave_searches():
+    brave_popularity.decay()
+    now = time.time()
+    for cache_key, (api_key, params) in brave_popularity.top(BRAVE_PREFETCH_TOP_N, BRAVE_PREFETCH_MIN_HITS):
+        _, fresh_until = brave_cache.peek(cache_key)
+        if fresh_until is None or fresh_until - now <= BRAVE_PREFETCH_LEAD:
+            brave_refresher.submit(cache_key, lambda args=(api_key, params, cache_key): refresh_brave_summary(*args, BRAVE_PREFETCH_LEAD), 'prefetch')
+
+brave_prefetch_scheduler = PrefetchScheduler('brave', BRAVE_PREFETCH_INTERVAL, prefetch_popular_brave_searches)
+
+def cached_brave_summary(api_key, params, cache_key):
+    """The cached summary for ``cache_key``, or None. A recently expired one is returned too, and refreshed in the background."""
+    if BRAVE_PREFETCH_ENABLED and brave_cache.enabled and is_time_sensitive(params):
+        brave_popularity.record(cache_key, (api_key, params))
+        brave_prefetch_scheduler.ensure_started()
+    max_stale = min(BRAVE_SWR_WINDOW, BRAVE_SWR_MAX_TTL_FRACTION * brave_cache_ttl(params)) if BRAVE_SWR_ENABLED else 0
+    summary, fresh_until = brave_cache.get_entry(cache_key, max_stale=max_stale)
+    if summary is None:
+        return None
+    if fresh_until <= time.time():
+        logging.info(f"Brave cache stale hit, refreshing in background. Query: '{params['q']}'")
+        brave_refresher.submit(cache_key, lambda: refresh_brave_summary(api_key, params, cache_key, 0), 'stale')
+    else:
+        logging.info(f"Brave cache hit. Query: '{params['q']}'")
+    return summary
+
+def search_brave(api_key, params):
+    cache_key = make_cache_key(params, api_key)
+    cached_summary = cached_brave_summary(api_key, params, cache_key)
+    if cached_summary is not None:
+        return cached_summary
+
+    # Identical searches arriving while one is already in flight share its result.
+    try:
+        return brave_flight.do(cache_key, lambda: fetch_brave_summary(api_key, params, cache_key))
+    except Exception as e:
+        return brave_stale_fallback(e, params, cache_key)
+
+def brave_stale_fallback(err, params, cache_key, network_errors=(OSError,)):
+    """Return a stale summary to answer with instead of ``err``, or re-raise ``err`` if there is none."""
+    stale_summary = brave_cache.get_stale(cache_key) if is_unavailable_error(err, network_errors) else None
+    if stale_summary is None:
+        raise err
+    logging.warning(f"Brave API unavailable ({err}). Serving stale result. Query: '{params['q']}'")
+    return stale_summary
+
+def describe_brave_http_error(response):
+    # Works for both requests and httpx responses.
+    reason = getattr(response, 'reason', None) or getattr(response, 'reason_phrase', '')
+    error_message = f'Brave API HTTP error: {response.status_code} - {reason}'
+    try:
+        brave_error_details = response.json()
+        error_message += f". Details: {brave_error_details.get('message', brave_error_details) if isinstance(brave_error_details, dict) else brave_error_details}"
+    except ValueError: # If Brave error response is not JSON
+        error_message += f". Response body (partial): {response.text[:200]}"
+    
+    logging.error(f"HTTPError when calling Brave API: {error_message}")
+    return error_message, 'Error communicating with the search service.', getattr(response, 'status_code', 500)
+
+def describe_brave_error(err):
+    """Map an exception raised while searching to ``(error, search_summary, status_code)``."""
+    if isinstance(err, CircuitOpenError):
+        error_message = f'Brave API temporarily unavailable: {str(err)}'
+        logging.error(error_message)
+        return error_message, 'The search service is temporarily unavailable. Please try again shortly.', 503
+
+    if isinstance(err, RateLimitExceeded):
+        error_message = f'Brave API rate limit reached: {str(err)}'
+        logging.warning(error_message)
+        return error_message, 'Too many searches with this API key. Please wait a moment and try again.', 429
+
+    if isinstance(err, requests.exceptions.HTTPError):
+        return describe_brave_http_error(err.response)
+
+    if isinstance(err, requests.exceptions.RequestException):
+        error_message = f'Network or Request error when calling Brave API: {str(err)}'
+        logging.error(error_message)
+        return error_message, 'Error connecting to the search service.', 500
+
+    error_message = f'An unexpected server error occurred: {str(err)}'
+    # exc_info will include the full traceback in the log
+    logging.error(error_message, exc_info=err) 
+    return error_message, 'An unexpected error occurred while processing your search.', 500
+
+def merge_brave_results(brave_data_list):
+    """Combine several Brave responses into one, dropping results whose URL was already seen."""
+    merged = {}
+    seen_urls = set()
+    for brave_data in brave_data_list:
+        for key_in_json in ('web', 'news', 'videos', 'discussions', 'locations'):
+            results = (brave_data.get(key_in_json) or {}).get('results') or []
+            for item in results:
+                url = item.get('url') or item.get('website')
+                if url:
+                    if url in seen_urls:
+                        continue
+                    seen_urls.add(url)
+                merged.setdefault(key_in_json, {'results': []})['results'].append(item)
+        # Keep the summary/infobox of the first query that produced one.
+        for key_in_json in ('mixed', 'infobox'):
+            if key_in_json not in merged and brave_data.get(key_in_json):
+                merged[key_in_json] = brave_data[key_in_json]
+    return merged
+
+def _batch_key_semaphore(api_key):
+    key_hash = hash_credential(api_key)
+    with _batch_semaphores_lock:
+        semaphore = _batch_semaphores.get(key_hash)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(BRAVE_BATCH_PER_KEY_CONCURRENCY)
+            _batch_semaphores[key_hash] = semaphore
+    return semaphore
+
+def run_brave_batch(jobs, search):
+    """Call ``search(api_key, params)`` for every job concurrently; returns each result or exception, in order."""
+    def run(api_key, params):
+        with _batch_key_semaphore(api_key):
+            return search(api_key, params)
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), BRAVE_BATCH_PER_KEY_CONCURRENCY)) as executor:
+        # Each job runs in a copy of the request context so its stage timings are attributed to it.
+        futures = [executor.submit(contextvars.copy_context().run, run, api_key, params) for api_key, params in jobs]
+    return [future.exception() or future.result() for future in futures]
+
+def fetch_merged_brave_summary(jobs, cache_key):
+    """Search every job and merge the results into ``{'search_summary', 'errors'}``, caching it if nothing failed."""
+    merged_inputs = []
+    errors = []
+    unavailable = False
+    for (api_key, params), outcome in zip(jobs, run_brave_batch(jobs, fetch_brave_data)):
+        if isinstance(outcome, Exception):
+            unavailable = unavailable or is_unavailable_error(outcome, (OSError,))
+            error_message, search_summary, status_code = describe_brave_error(outcome)
+            errors.append({'q': params['q'], 'error': error_message, 'search_summary': search_summary, 'status_code': status_code})
+        else:
+            merged_inputs.append(outcome)
+
+    if not merged_inputs and unavailable:
+        stale_summary = brave_cache.get_stale(cache_key)
+        if stale_summary is not None:
+            logging.warning("Brave API unavailable. Serving stale merged batch result.")
+            return {'search_summary': stale_summary}
+    if not merged_inputs:
+        response_body = {'search_summary': 'No relevant search results found or results could not be parsed.'}
+    else:
+        with stage('format'):
+            response_body = {'search_summary': format_brave_response_comprehensive(merge_brave_results(merged_inputs))}
+    if errors:
+        response_body['errors'] = errors
+    else:
+        brave_cache.set(cache_key, response_body['search_summary'], ttl=min(brave_cache_ttl(params) for _, params in jobs))
+    return response_body
+
+@brave_search_bp.route('/brave_search/cache_stats', methods=['GET'])
+def brave_search_cache_stats():
+    return jsonify(brave_cache.stats())
+
+@brave_search_bp.route('/brave_search/single_flight_stats', methods=['GET'])
+def brave_search_single_flight_stats():
+    return jsonify(brave_flight.stats())
 
 @brave_search_bp.route('/brave_search', methods=['OPTIONS', 'POST'])
 def brave_search():
@@ -140,92 +486,82 @@ def brave_search():
             logging.error("Search query is required but not provided.")
             return jsonify({'error': 'Search query is required', 'search_summary': 'Error: Search query missing.'}), 400
 
-        def is_valid_param(param_value, param_name_for_log="parameter"): # Added param_name_for_log for better logging
-            if param_value is None:
-                return False
-            s_value = str(param_value).strip()
-            if not s_value:
-                return False
-            lower_s_value = s_value.lower()
-            if lower_s_value == "undefined" or lower_s_value == "null":
-                return False
-            if s_value.startswith("{") and s_value.endswith("}"):
-                logging.info(f"Parameter '{param_name_for_log}' value ('{s_value}') looks like an unsubstituted placeholder. Treating as invalid.")
-                return False
-            return True
-
-        params = {'q': query}
-        param_mapping = {
-            'offset': data.get('offset'),
-            'freshness': data.get('freshness'),
-            'result_filter': data.get('result_filter'),
-            'country': data.get('country'),
-            'search_lang': data.get('searchLang'),
-            'count': data.get('count'),
-            'safesearch': data.get('safesearch'),
-            'goggles_id': data.get('gogglesId'),
-            'units': data.get('units')
-        }
-
-        for api_param, value in param_mapping.items():
-            if is_valid_param(value, api_param): # Pass api_param for logging context
-                if api_param in ['count', 'offset']:
-                    try:
-                        num_value = int(str(value))
-                        if api_param == 'offset':
-                            if num_value >= 0: params[api_param] = num_value
-                        elif api_param == 'count': 
-                            if num_value > 0: params[api_param] = min(num_value, 20) 
-                    except (ValueError, TypeError):
-                        logging.warning(f"Could not convert {api_param} ('{value}') to int. Skipping.")
-                        continue
+        params = build_brave_params(data)
+        if str(data.get('stream', False)).lower() == 'true':
+            cache_key = make_cache_key(params, api_key)
+            formatted_text_response = cached_brave_summary(api_key, params, cache_key)
+            if formatted_text_response is None:
+                try:
+                    brave_api_data = brave_flight.do('raw:' + cache_key, lambda: fetch_brave_data(api_key, params))
+                except Exception as e:
+                    formatted_text_response = brave_stale_fallback(e, params, cache_key)
                 else:
-                    params[api_param] = value
+                    return Response(stream_brave_summary(brave_api_data, params, cache_key), mimetype='application/json')
+        else:
+            formatted_text_response = search_brave(api_key, params)
         
-        if 'count' not in params:
-            params['count'] = 10
-            logging.debug("Parameter 'count' not provided or invalid, defaulting to 10.")
+        with stage('serialize'):
+            return jsonify({'search_summary': formatted_text_response})
 
+    except Exception as e:
+        error_message, search_summary, status_code = describe_brave_error(e)
+        headers = {'Retry-After': e.retry_after_header} if isinstance(e, RateLimitExceeded) else {}
+        return jsonify({'error': error_message, 'search_summary': search_summary}), status_code, headers
 
-        api_url = 'https://api.search.brave.com/res/v1/web/search'
-        headers = {
-            'Accept': 'application/json',
-            'Accept-Encoding': 'gzip',
-            'X-Subscription-Token': api_key,
-        }
+@brave_search_bp.route('/brave_search/batch', methods=['OPTIONS', 'POST'])
+def brave_search_batch():
+    if request.method == 'OPTIONS':
+        response = make_response()
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+        response.headers.add('Access-Control-Allow-Methods', 'POST')
+        return response
 
-        logging.info(f"Requesting Brave API. Query: '{query}', Params: {params}")
-        
-        api_response = requests.get(api_url, params=params, headers=headers, proxies=None)
-        api_response.raise_for_status()
-        
-        brave_api_data = api_response.json()
-        
-        # For debugging, you might want to see the raw data sometimes
-        # logging.debug(f"Raw Brave API Data: {brave_api_data}")
+    try:
+        data = request.get_json()
+        if not data:
+            logging.error("No JSON data provided in request.")
+            return jsonify({'error': 'No JSON data provided', 'search_summary': 'Error: No input data received by server.'}), 400
 
-        formatted_text_response = format_brave_response_comprehensive(brave_api_data)
-        
-        return jsonify({'search_summary': formatted_text_response})
-
-    except requests.exceptions.HTTPError as http_err:
-        error_message = f'Brave API HTTP error: {http_err.response.status_code} - {http_err.response.reason}'
-        try:
-            brave_error_details = http_err.response.json()
-            error_message += f". Details: {brave_error_details.get('message', brave_error_details)}"
-        except ValueError: # If Brave error response is not JSON
-            error_message += f". Response body (partial): {http_err.response.text[:200]}"
-        
-        logging.error(f"HTTPError when calling Brave API: {error_message}")
-        return jsonify({'error': error_message, 'search_summary': 'Error communicating with the search service.'}), getattr(http_err.response, 'status_code', 500)
+        queries = data.get('queries')
+        merge = str(data.get('merge', False)).lower() == 'true'
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'error': 'A non-empty list of queries is required', 'search_summary': 'Error: Search queries missing.'}), 400
+        if len(queries) > BRAVE_BATCH_MAX_QUERIES:
+            return jsonify({'error': f'At most {BRAVE_BATCH_MAX_QUERIES} queries are allowed per batch', 'search_summary': 'Error: Too many search queries.'}), 400
+
+        jobs = []
+        for index, query_data in enumerate(queries):
+            if not isinstance(query_data, dict):
+                query_data = {'q': query_data}
+            # Fields missing from a query object fall back to the batch-level values.
+            query_data = {**{k: v for k, v in data.items() if k not in ('queries', 'merge')}, **query_data}
+            api_key = query_data.get('braveSearchAPIKey')
+            if not api_key:
+                return jsonify({'error': 'Brave Search API Key is required', 'search_summary': 'Error: API Key missing. Please configure the plugin.'}), 400
+            if not is_valid_param(query_data.get('q'), f'queries[{index}].q'):
+                return jsonify({'error': f'Search query is required for queries[{index}]', 'search_summary': 'Error: Search query missing.'}), 400
+            jobs.append((api_key, build_brave_params(query_data)))
+
+        if merge:
+            merge_key = make_cache_key({'merge': [params for _, params in jobs]},
+                                       ' '.join(hash_credential(api_key) for api_key, _ in jobs))
+            cached_summary = brave_cache.get(merge_key)
+            if cached_summary is not None:
+                return jsonify({'search_summary': cached_summary})
+            # Identical merged searches arriving while one is in flight share its result.
+            return jsonify(brave_flight.do(merge_key, lambda: fetch_merged_brave_summary(jobs, merge_key)))
+
+        results = []
+        for (api_key, params), outcome in zip(jobs, run_brave_batch(jobs, search_brave)):
+            if isinstance(outcome, Exception):
+                error_message, search_summary, status_code = describe_brave_error(outcome)
+                results.append({'q': params['q'], 'error': error_message, 'search_summary': search_summary, 'status_code': status_code})
+            else:
+                results.append({'q': params['q'], 'search_summary': outcome})
+        return jsonify({'results': results})
 
-    except requests.exceptions.RequestException as req_err:
-        error_message = f'Network or Request error when calling Brave API: {str(req_err)}'
-        logging.error(error_message)
-        return jsonify({'error': error_message, 'search_summary': 'Error connecting to the search service.'}), 500
-        
     except Exception as e:
-        error_message = f'An unexpected server error occurred: {str(e)}'
-        # exc_info=True will include the full traceback in the log
-        logging.error(error_message, exc_info=True) 
-        return jsonify({'error': error_message, 'search_summary': 'An unexpected error occurred while processing your search.'}), 500
+        error_message, search_summary, status_code = describe_brave_error(e)
+        headers = {'Retry-After': e.retry_after_header} if isinstance(e, RateLimitExceeded) else {}
+        return jsonify({'error': error_message, 'search_summary': search_summary}), status_code, headers
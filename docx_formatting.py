@@ -0,0 +1,147 @@
+import hashlib
+import json
+from functools import lru_cache
+
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING, WD_TAB_ALIGNMENT, WD_TAB_LEADER
+from docx.shared import Inches, Pt, RGBColor
+from docx.text.font import Font
+
+# paragraph_format keys mapped to the converter applied to the requested value.
+_PARAGRAPH_CONVERTERS = {
+    'alignment': lambda value: getattr(WD_ALIGN_PARAGRAPH, value, WD_ALIGN_PARAGRAPH.LEFT),
+    'line_spacing': lambda value: value,
+    'line_spacing_rule': lambda value: getattr(WD_LINE_SPACING, value, WD_LINE_SPACING.SINGLE),
+    'first_line_indent': Inches,
+    'left_indent': Inches,
+    'right_indent': Inches,
+    'space_before': Pt,
+    'space_after': Pt,
+    'keep_together': lambda value: value,
+    'keep_with_next': lambda value: value,
+    'page_break_before': lambda value: value,
+    'widow_control': lambda value: value,
+}
+
+
+def canonical_spec(spec):
+    return json.dumps(spec, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def spec_digest(canonical):
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:10]
+
+
+class ParagraphFormatApplier:
+    def __init__(self, spec):
+        self.attributes = []
+        self.tab_stops = []
+        for key, value in spec.items():
+            if key == 'tab_stops':
+                for tab_stop in value:
+                    self.tab_stops.append((
+                        Inches(tab_stop.get('position', 0)),
+                        getattr(WD_TAB_ALIGNMENT, tab_stop.get('alignment', 'LEFT'), WD_TAB_ALIGNMENT.LEFT),
+                        getattr(WD_TAB_LEADER, tab_stop.get('leader', 'SPACES'), WD_TAB_LEADER.SPACES)
+                    ))
+            elif key in _PARAGRAPH_CONVERTERS:
+                self.attributes.append((key, _PARAGRAPH_CONVERTERS[key](value)))
+
+    def __call__(self, p_format):
+        for attribute, value in self.attributes:
+            setattr(p_format, attribute, value)
+        for position, alignment, leader in self.tab_stops:
+            p_format.tab_stops.add_tab_stop(position, alignment=alignment, leader=leader)
+
+
+class FontApplier:
+    def __init__(self, spec):
+        self.color = None
+        self.attributes = []
+        for font_key, font_value in spec.items():
+            if font_key == 'color':
+                if isinstance(font_value, str) and font_value.startswith('#'):
+                    try:
+                        self.color = RGBColor.from_string(font_value[1:])
+                    except ValueError:
+                        print(f"Invalid color format: {font_value}. Skipping.")
+                else:
+                    print(f"Invalid color format: {font_value}. Skipping.")
+            elif font_key == 'size':
+                self.attributes.append(('size', Pt(font_value)))
+            elif not font_key.startswith('_') and hasattr(Font, font_key):
+                self.attributes.append((font_key, font_value))
+
+    def __call__(self, font):
+        if self.color is not None:
+            font.color.rgb = self.color
+        for attribute, value in self.attributes:
+            setattr(font, attribute, value)
+
+
+@lru_cache(maxsize=1024)
+def _compile_paragraph_format(canonical):
+    return ParagraphFormatApplier(json.loads(canonical))
+
+
+@lru_cache(maxsize=1024)
+def _compile_font(canonical):
+    return FontApplier(json.loads(canonical))
+
+
+def compile_paragraph_format(spec):
+    """Return a memoized callable that applies a ``paragraph_format`` spec to a ParagraphFormat."""
+    return _compile_paragraph_format(canonical_spec(spec))
+
+
+def compile_font(spec):
+    """Return a memoized callable that applies a ``font`` spec to a Font."""
+    return _compile_font(canonical_spec(spec))
+
+
+class DocumentFormatter:
+    """Applies paragraph and font specs to one document.
+
+    With ``shared_styles`` enabled, every distinct spec becomes a style that
+    is created once and referenced by each element using it, instead of
+    repeating the same direct formatting on every paragraph and run.
+    """
+
+    def __init__(self, document, styles=None, shared_styles=False):
+        self.document = document
+        self.styles = document.styles if styles is None else styles
+        self.shared_styles = shared_styles
+        self._created_styles = {}
+
+    def _shared_style(self, kind, canonical, base_style):
+        base_name = base_style.name if base_style is not None else None
+        key = (kind, canonical, base_name)
+        style = self._created_styles.get(key)
+        if style is None:
+            digest = spec_digest(f"{canonical}|{base_name}")
+            if kind == 'paragraph':
+                style = self.document.styles.add_style(f"Auto Paragraph {digest}", WD_STYLE_TYPE.PARAGRAPH)
+                style.base_style = base_style if base_style is not None else self.styles['Normal']
+                _compile_paragraph_format(canonical)(style.paragraph_format)
+            else:
+                style = self.document.styles.add_style(f"Auto Character {digest}", WD_STYLE_TYPE.CHARACTER)
+                _compile_font(canonical)(style.font)
+            style.quick_style = False
+            self._created_styles[key] = style
+        return style
+
+    def format_paragraph(self, paragraph, spec, base_style=None):
+        canonical = canonical_spec(spec)
+        if self.shared_styles:
+            # Assign the style id on the element directly; the python-docx setter
+            # looks the style up again on every call.
+            paragraph._p.style = self._shared_style('paragraph', canonical, base_style).style_id
+        else:
+            _compile_paragraph_format(canonical)(paragraph.paragraph_format)
+
+    def format_run(self, run, spec):
+        canonical = canonical_spec(spec)
+        if self.shared_styles:
+            run._r.style = self._shared_style('character', canonical, None).style_id
+        else:
+            _compile_font(canonical)(run.font)
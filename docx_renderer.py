@@ -0,0 +1,288 @@
+from docx_templates import get_template, new_document
+from docx_tables import DOCX_BULK_TABLE_MIN_CELLS, fill_table_bulk, table_rows_from_item
+from docx_formatting import DocumentFormatter, compile_font, compile_paragraph_format
+from docx.shared import Inches
+from docx.enum.text import WD_UNDERLINE
+from docx.enum.table import WD_TABLE_ALIGNMENT, WD_CELL_VERTICAL_ALIGNMENT, WD_TABLE_DIRECTION
+from docx.enum.section import WD_SECTION_START, WD_ORIENTATION
+import io
+import json
+from image_fetcher import fetch_image, fetch_images
+from metrics import stage
+from generate_docx import DOCX_MAX_CONTENT_ITEMS, TooManyContentItems
+from datetime import datetime
+
+# The python-docx rendering code behind /generate_docx. It is the heaviest import
+# in the app, so generate_docx.py only imports it once a document is requested.
+
+def preload():
+    """Parse the default template now instead of on the first request."""
+    get_template()
+
+def process_core_properties(core_properties_data, core_properties):
+    if core_properties_data:
+        for prop, value in core_properties_data.items():
+            if hasattr(core_properties, prop):
+                if prop in ['created', 'modified', 'last_printed']:
+                    try:
+                        setattr(core_properties, prop, datetime.fromisoformat(value))
+                    except (ValueError, TypeError):
+                        print(f"Invalid date format for {prop}: {value}. Skipping.")
+                    except Exception as e:
+                        print(f"Error setting core property {prop}: {e}")
+                else:
+                    setattr(core_properties, prop, value)
+
+def process_headers_footers(section, headers_data, footers_data):
+    def apply_paragraph_formatting(paragraph, format_data):
+        if format_data:
+            compile_paragraph_format(format_data)(paragraph.paragraph_format)
+    def apply_font_formatting(paragraph, font_data):
+        if font_data:
+            if not paragraph.runs:
+                paragraph.add_run()
+            compile_font(font_data)(paragraph.runs[0].font)
+
+    if headers_data:
+        for header_type, header_content in headers_data.items():
+            if header_type == "FIRST":
+                header = section.first_page_header
+            elif header_type == "EVEN":
+                header = section.even_page_header
+            else:
+                header = section.header
+
+            if header:
+                header.is_linked_to_previous = False
+                if header.paragraphs:
+                    paragraph = header.paragraphs[0]
+                    paragraph.text = header_content
+                else:
+                    paragraph = header.add_paragraph(header_content)
+
+                apply_paragraph_formatting(paragraph, headers_data.get('paragraph_format'))
+                if 'font' in headers_data:
+                    apply_font_formatting(paragraph, headers_data['font'])
+
+    if footers_data:
+        for footer_type, footer_content in footers_data.items():
+            if footer_type == "FIRST":
+                footer = section.first_page_footer
+            elif footer_type == "EVEN":
+                footer = section.even_page_footer
+            else:
+                footer = section.footer
+
+            if footer:
+                footer.is_linked_to_previous = False
+                if footer.paragraphs:
+                    paragraph = footer.paragraphs[0]
+                    paragraph.text = footer_content
+                else:
+                    paragraph = header.add_paragraph(header_content)
+                if 'paragraph_format' in footers_data:
+                    apply_paragraph_formatting(paragraph, footers_data['paragraph_format'])
+                if 'font' in footers_data:
+                    apply_font_formatting(paragraph, footers_data['font'])
+
+def process_sections(document, sections_data, default_page_width, default_page_height,
+                     default_left_margin, default_right_margin, default_top_margin,
+                     default_bottom_margin, default_gutter, default_header_distance,
+                     default_footer_distance, default_orientation):
+    for section_data in sections_data:
+        section = document.add_section(start_type=getattr(WD_SECTION_START, section_data.get('start_type', 'NEW_PAGE'), WD_SECTION_START.NEW_PAGE))
+        section.orientation = getattr(WD_ORIENTATION, section_data.get('orientation', default_orientation), WD_ORIENTATION.PORTRAIT)
+        section.page_width = Inches(section_data.get('page_width', default_page_width))
+        section.page_height = Inches(section_data.get('page_height', default_page_height))
+        section.left_margin = Inches(section_data.get('left_margin', default_left_margin))
+        section.right_margin = Inches(section_data.get('right_margin', default_right_margin))
+        section.top_margin = Inches(section_data.get('top_margin', default_top_margin))
+        section.bottom_margin = Inches(section_data.get('bottom_margin', default_bottom_margin))
+        section.gutter = Inches(section_data.get('gutter', default_gutter))
+        section.header_distance = Inches(section_data.get('header_distance', default_header_distance))
+        section.footer_distance = Inches(section_data.get('footer_distance', default_footer_distance))
+        process_headers_footers(section, section_data.get('headers'), section_data.get('footers'))
+
+def process_paragraph(document, item, styles=None, formatter=None):
+    style_name = item.get('style')
+    style = None
+    if style_name:
+        try:
+            style = (document.styles if styles is None else styles)[style_name]
+        except KeyError:
+            print(f"Style '{style_name}' not found. Using default style.")
+    paragraph = document.add_paragraph(item.get('text', ''), style=style)
+    if formatter is None:
+        formatter = DocumentFormatter(document, styles)
+    if 'paragraph_format' in item:
+        formatter.format_paragraph(paragraph, item['paragraph_format'], style)
+    if 'runs' in item:
+        for run_data in item['runs']:
+            run = paragraph.add_run(run_data.get('text', ''))
+            if 'font' in run_data:
+                formatter.format_run(run, run_data['font'])
+            if 'bold' in run_data:
+                run.bold = run_data['bold']
+            if 'italic' in run_data:
+                run.italic = run_data['italic']
+            if 'underline' in run_data:
+                run.underline = getattr(WD_UNDERLINE, run_data['underline'], WD_UNDERLINE.NONE)
+
+def process_table(document, item, styles=None):
+    table_data = table_rows_from_item(item) if 'data' in item or 'columns' in item else None
+    if table_data is not None and (isinstance(item.get('data'), str) or 'columns' in item):
+        # Sized from the data when it comes as CSV/TSV or columns.
+        rows = item.get('rows', len(table_data))
+        cols = item.get('cols', max((len(row) for row in table_data), default=1))
+    else:
+        rows = item.get('rows', 1)
+        cols = item.get('cols', 1)
+    style_name = item.get('style')
+    style = None
+    if style_name:
+        try:
+            style = (document.styles if styles is None else styles)[style_name]
+        except KeyError:
+            print(f"Style '{style_name}' not found. Using default style.")
+    bulk_fill = table_data is not None and rows * cols >= DOCX_BULK_TABLE_MIN_CELLS
+    table = document.add_table(rows=0 if bulk_fill else rows, cols=cols, style=style)
+    if 'alignment' in item:
+        table.alignment = getattr(WD_TABLE_ALIGNMENT, item['alignment'], WD_TABLE_ALIGNMENT.LEFT)
+    if 'table_direction' in item:
+        table.table_direction = getattr(WD_TABLE_DIRECTION, item['table_direction'], WD_TABLE_DIRECTION.LTR)
+    if 'autofit' in item:
+        table.autofit = item['autofit']
+    if bulk_fill:
+        vertical_alignment = None
+        if 'vertical_alignment' in item:
+            vertical_alignment = getattr(WD_CELL_VERTICAL_ALIGNMENT, item['vertical_alignment'], WD_CELL_VERTICAL_ALIGNMENT.TOP).xml_value
+        fill_table_bulk(table, table_data, rows, cols, vertical_alignment)
+    elif table_data is not None:
+        num_rows = min(rows, len(table_data))
+        for row_idx in range(num_rows):
+            row_data = table_data[row_idx]
+            num_cols = min(cols, len(row_data))
+            for col_idx in range(num_cols):
+                cell = table.cell(row_idx, col_idx)
+                cell.text = str(row_data[col_idx])
+                if 'vertical_alignment' in item:
+                    cell.vertical_alignment = getattr(WD_CELL_VERTICAL_ALIGNMENT, item['vertical_alignment'], WD_CELL_VERTICAL_ALIGNMENT.TOP)
+
+def process_image(document, item, prefetched_images=None):
+    try:
+        if prefetched_images is not None and item['url'] in prefetched_images:
+            image_data = prefetched_images[item['url']]
+            if isinstance(image_data, Exception):
+                raise image_data
+        else:
+            image_data = fetch_image(item['url'])
+        image_stream = io.BytesIO(image_data)
+        paragraph = document.add_paragraph()
+        run = paragraph.add_run()
+        width = Inches(item.get('width', 3))
+        height = Inches(item.get('height', 2))
+        run.add_picture(image_stream, width=width, height=height)
+    except Exception as e:
+        print(f"Error adding image: {e}")
+
+def start_document(data):
+    """Create the document and apply the document-level settings in ``data``, without any content."""
+    default_page_width = data.get('defaultPageWidth', 8.5)
+    default_page_height = data.get('defaultPageHeight', 11)
+    default_left_margin = data.get('defaultLeftMargin', 1)
+    default_right_margin = data.get('defaultRightMargin', 1)
+    default_top_margin = data.get('defaultTopMargin', 1)
+    default_bottom_margin = data.get('defaultBottomMargin', 1)
+    default_gutter = data.get('defaultGutter', 0)
+    default_header_distance = data.get('defaultHeaderDistance', 0.5)
+    default_footer_distance = data.get('defaultFooterDistance', 0.5)
+    default_orientation = data.get('defaultOrientation', "PORTRAIT")
+    enable_core_properties = data.get('enableCoreProperties', "false") == "true"
+    core_properties_title = data.get('corePropertiesTitle', "")
+    core_properties_author = data.get('corePropertiesAuthor', "")
+    core_properties_created = data.get('corePropertiesCreated', "")
+    odd_and_even_pages_header_footer = data.get('oddAndEvenPagesHeaderFooter', "false") == "true"
+
+    try:
+        document, styles = new_document(data.get('templateId') or None)
+    except KeyError:
+        raise ValueError(f"Unknown templateId: {data.get('templateId')}")
+    # Distinct paragraph/font specs become shared styles when useSharedStyles is set.
+    formatter = DocumentFormatter(document, styles, shared_styles=data.get('useSharedStyles', "false") == "true")
+    settings = document.settings
+    settings.odd_and_even_pages_header_footer = odd_and_even_pages_header_footer
+
+    if enable_core_properties:
+        core_properties = document.core_properties
+        core_properties_data = {}
+        if core_properties_title:
+            core_properties_data['title'] = core_properties_title
+        if core_properties_author:
+            core_properties_data['author'] = core_properties_author
+        if core_properties_created:
+            core_properties_data['created'] = core_properties_created
+        process_core_properties(core_properties_data, core_properties)
+
+    process_sections(document, data.get('sections', []), default_page_width, default_page_height,
+                     default_left_margin, default_right_margin, default_top_margin,
+                     default_bottom_margin, default_gutter, default_header_distance,
+                     default_footer_distance, default_orientation)
+    return document, styles, formatter
+
+def render_content_item(document, item, styles, formatter, prefetched_images=None):
+    if item['type'] == 'heading':
+        document.add_heading(item.get('text', ''), level=item.get('level', 1))
+    elif item['type'] == 'paragraph':
+        process_paragraph(document, item, styles, formatter)
+    elif item['type'] == 'table':
+        process_table(document, item, styles)
+    elif item['type'] == 'image':
+        process_image(document, item, prefetched_images)
+    elif item['type'] == 'list':
+        list_style = styles[item.get('numbering_style') or item.get('style', 'List Bullet')]
+        for list_item in item.get('items', []):
+            document.add_paragraph(list_item, style=list_style)
+    elif item['type'] == 'page_break':
+        document.add_page_break()
+
+def image_urls(content):
+    return [item['url'] for item in content if item.get('type') == 'image' and item.get('url')]
+
+def build_document(data, prefetched_images=None):
+    content = data.get('content', [])
+    if prefetched_images is None:
+        # Download every image up front and in parallel instead of one by one while rendering.
+        with stage('images'):
+            prefetched_images = fetch_images(image_urls(content))
+    with stage('render'):
+        document, styles, formatter = start_document(data)
+        for item in content:
+            render_content_item(document, item, styles, formatter, prefetched_images)
+    return document
+
+def build_document_from_ndjson(stream):
+    """Render an NDJSON body: document settings on the first line, then one content item per line.
+
+    Each item is rendered as soon as its line is parsed, so the request never
+    holds more than one parsed item in memory. Returns ``(document, settings)``,
+    or ``(None, None)`` for an empty body.
+    """
+    lines = (line for line in stream if line.strip())
+    first_line = next(lines, None)
+    if first_line is None:
+        return None, None
+    data = json.loads(first_line)
+    if not isinstance(data, dict):
+        raise ValueError('The first NDJSON line must be an object with the document parameters.')
+    item_count = len(data.get('content', []))
+    if item_count > DOCX_MAX_CONTENT_ITEMS:
+        raise TooManyContentItems(f"At most {DOCX_MAX_CONTENT_ITEMS} content items are allowed.")
+    document, styles, formatter = start_document(data)
+    for item in data.get('content', []):
+        render_content_item(document, item, styles, formatter)
+    for line in lines:
+        item_count += 1
+        if item_count > DOCX_MAX_CONTENT_ITEMS:
+            raise TooManyContentItems(f"At most {DOCX_MAX_CONTENT_ITEMS} content items are allowed.")
+        render_content_item(document, json.loads(line), styles, formatter)
+    return document, data
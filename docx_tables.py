@@ -0,0 +1,85 @@
+import csv
+import io
+import os
+import re
+from xml.sax.saxutils import escape
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+
+# Tables with at least this many cells are filled by building the row XML in one
+# pass instead of going through table.cell() for every cell.
+DOCX_BULK_TABLE_MIN_CELLS = int(os.environ.get('DOCX_BULK_TABLE_MIN_CELLS', 50))
+
+_RUN_BREAKS = re.compile(r'([\t\r\n])')
+
+
+def table_rows_from_item(item):
+    """Return the table data of ``item`` as a list of rows.
+
+    ``data`` may be a list of rows or a CSV/TSV string (``data_format``
+    "csv" or "tsv"). ``columns`` is a column-oriented alternative: a list of
+    ``{"header": ..., "values": [...]}`` objects or a mapping of header to
+    values; the headers become the first row.
+    """
+    if 'columns' in item:
+        columns = item['columns']
+        if isinstance(columns, dict):
+            columns = [{'header': header, 'values': values} for header, values in columns.items()]
+        headers = [column.get('header', '') for column in columns]
+        values = [column.get('values', []) for column in columns]
+        height = max((len(column_values) for column_values in values), default=0)
+        rows = [headers] if any(header != '' for header in headers) else []
+        for row_idx in range(height):
+            rows.append([column_values[row_idx] if row_idx < len(column_values) else '' for column_values in values])
+        return rows
+
+    data = item.get('data', [])
+    if isinstance(data, str):
+        delimiter = '\t' if str(item.get('data_format', 'csv')).lower() == 'tsv' else ','
+        return list(csv.reader(io.StringIO(data), delimiter=delimiter))
+    return data
+
+
+def _run_xml(text):
+    parts = []
+    for piece in _RUN_BREAKS.split(text):
+        if not piece:
+            continue
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in '\r\n':
+            parts.append('<w:br/>')
+        elif piece != piece.strip():
+            parts.append(f'<w:t xml:space="preserve">{escape(piece)}</w:t>')
+        else:
+            parts.append(f'<w:t>{escape(piece)}</w:t>')
+    return f"<w:p><w:r>{''.join(parts)}</w:r></w:p>" if parts else '<w:p><w:r/></w:p>'
+
+
+def fill_table_bulk(table, rows_data, rows, cols, vertical_alignment=None):
+    """Append ``rows`` rows of ``cols`` cells to an empty table, filled from ``rows_data``.
+
+    Produces the same XML as adding the rows and setting ``cell.text`` and
+    ``cell.vertical_alignment`` cell by cell. The cell properties are rendered
+    once per column and the whole table is parsed in a single call.
+    """
+    widths = [grid_col.get(qn('w:w')) for grid_col in table._tbl.tblGrid.findall(qn('w:gridCol'))]
+    v_align = f'<w:vAlign w:val="{vertical_alignment}"/>' if vertical_alignment else ''
+    filled_cell_start = [f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/>{v_align}</w:tcPr>' for width in widths]
+    empty_cells = [f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr><w:p/></w:tc>' for width in widths]
+
+    chunks = [f'<w:tbl {nsdecls("w")}>']
+    for row_idx in range(rows):
+        row_data = rows_data[row_idx] if row_idx < len(rows_data) else ()
+        num_cols = min(cols, len(row_data))
+        chunks.append('<w:tr>')
+        for col_idx in range(num_cols):
+            chunks.append(filled_cell_start[col_idx])
+            chunks.append(_run_xml(str(row_data[col_idx])))
+            chunks.append('</w:tc>')
+        chunks.extend(empty_cells[num_cols:cols])
+        chunks.append('</w:tr>')
+    chunks.append('</w:tbl>')
+
+    table._tbl.extend(list(parse_xml(''.join(chunks))))
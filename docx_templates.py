@@ -0,0 +1,150 @@
+import copy
+import io
+import os
+import re
+import threading
+import zipfile
+
+from docx import Document
+from docx.oxml.ns import qn
+from docx.styles.style import StyleFactory
+
+DOCX_TEMPLATE_DIR = os.environ.get('DOCX_TEMPLATE_DIR', '/tmp/docx_templates')
+TEMPLATE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+_TEMPLATE_CONTENT_TYPE = b'application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml'
+_DOCUMENT_CONTENT_TYPE = b'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml'
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+class DocumentTemplate:
+    """A parsed base document that is deep-copied for every request.
+
+    Copying the already-parsed element tree is much cheaper than having
+    python-docx unzip and parse the package again. The style name index maps
+    each style's UI and internal name to its position in the styles part, which
+    is identical in every copy.
+    """
+
+    def __init__(self, document, mtime=None):
+        self.document = document
+        self.mtime = mtime
+        styles_element = document.styles.element
+        self.style_positions = {}
+        for position, child in enumerate(styles_element):
+            if child.tag != qn('w:style'):
+                continue
+            style = StyleFactory(child)
+            self.style_positions.setdefault(style.name, position)
+            self.style_positions.setdefault(child.name_val, position)
+
+    def new_document(self):
+        document = copy.deepcopy(self.document)
+        return document, StyleIndex(document, self.style_positions)
+
+
+class StyleIndex:
+    """Drop-in replacement for ``document.styles[name]`` lookups on a template copy."""
+
+    def __init__(self, document, style_positions):
+        self.styles = document.styles
+        self.style_positions = style_positions
+        self._resolved = {}
+
+    def __getitem__(self, name):
+        style = self._resolved.get(name)
+        if style is not None:
+            return style
+        position = self.style_positions.get(name)
+        if position is None:
+            # Styles added after the template was loaded are not in the index.
+            style = self.styles[name]
+        else:
+            style = StyleFactory(self.styles.element[position])
+        self._resolved[name] = style
+        return style
+
+
+def _read_template_file(path):
+    # python-docx refuses .dotx packages, which differ from .docx only in the
+    # main part's content type, so rewrite that before opening it.
+    with open(path, 'rb') as f:
+        raw = f.read()
+    with zipfile.ZipFile(io.BytesIO(raw)) as source:
+        content_types = source.read('[Content_Types].xml')
+        if _TEMPLATE_CONTENT_TYPE not in content_types:
+            return Document(io.BytesIO(raw))
+        converted = io.BytesIO()
+        with zipfile.ZipFile(converted, 'w', zipfile.ZIP_DEFLATED) as target:
+            for info in source.infolist():
+                data = source.read(info.filename)
+                if info.filename == '[Content_Types].xml':
+                    data = content_types.replace(_TEMPLATE_CONTENT_TYPE, _DOCUMENT_CONTENT_TYPE)
+                target.writestr(info, data)
+    converted.seek(0)
+    return Document(converted)
+
+
+def template_path(template_id):
+    return os.path.join(DOCX_TEMPLATE_DIR, f"{template_id}.dotx")
+
+
+def save_template(template_id, raw):
+    """Validate and store an uploaded .dotx/.docx template under ``template_id``."""
+    if not TEMPLATE_ID_PATTERN.match(template_id):
+        raise ValueError('Template id may only contain letters, digits, "-" and "_".')
+    os.makedirs(DOCX_TEMPLATE_DIR, exist_ok=True)
+    path = template_path(template_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+    try:
+        _read_template_file(tmp_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise ValueError('Uploaded file is not a valid .dotx or .docx package.')
+    os.replace(tmp_path, path)
+    with _templates_lock:
+        _templates.pop(template_id, None)
+
+
+def list_templates():
+    if not os.path.isdir(DOCX_TEMPLATE_DIR):
+        return []
+    return sorted(name[:-5] for name in os.listdir(DOCX_TEMPLATE_DIR) if name.endswith('.dotx'))
+
+
+def get_template(template_id=None):
+    """Return the cached DocumentTemplate for ``template_id`` (None is python-docx's default)."""
+    if template_id is None:
+        template = _templates.get(None)
+        if template is None:
+            with _templates_lock:
+                template = _templates.get(None)
+                if template is None:
+                    template = DocumentTemplate(Document())
+                    _templates[None] = template
+        return template
+
+    if not TEMPLATE_ID_PATTERN.match(str(template_id)):
+        raise KeyError(template_id)
+    path = template_path(template_id)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        raise KeyError(template_id)
+    template = _templates.get(template_id)
+    # Templates can be re-uploaded by another worker, so reload when the file changes.
+    if template is None or template.mtime != mtime:
+        with _templates_lock:
+            template = _templates.get(template_id)
+            if template is None or template.mtime != mtime:
+                template = DocumentTemplate(_read_template_file(path), mtime)
+                _templates[template_id] = template
+    return template
+
+
+def new_document(template_id=None):
+    """Return ``(document, style_index)`` for a fresh copy of the requested template."""
+    return get_template(template_id).new_document()
@@ -1,260 +1,144 @@
 from flask import Flask, request, jsonify, send_file, url_for, Blueprint
 from flask_cors import CORS
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING, WD_TAB_ALIGNMENT, WD_TAB_LEADER, WD_UNDERLINE
-from docx.enum.table import WD_TABLE_ALIGNMENT, WD_CELL_VERTICAL_ALIGNMENT, WD_TABLE_DIRECTION
-from docx.enum.section import WD_SECTION_START, WD_ORIENTATION
+from werkzeug.exceptions import RequestEntityTooLarge
 import io
+import logging
 import uuid
 import os
-import requests
-from datetime import datetime
+from artifact_store import create_artifact_store
+from admin_auth import check_admin_token
+from metrics import stage
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 generate_docx_bp = Blueprint('generate_docx', __name__)
 CORS(generate_docx_bp, resources={r"/*": {"origins": "*"}})
-generated_files = {}
-
-def process_core_properties(core_properties_data, core_properties):
-    if core_properties_data:
-        for prop, value in core_properties_data.items():
-            if hasattr(core_properties, prop):
-                if prop in ['created', 'modified', 'last_printed']:
-                    try:
-                        setattr(core_properties, prop, datetime.fromisoformat(value))
-                    except (ValueError, TypeError):
-                        print(f"Invalid date format for {prop}: {value}. Skipping.")
-                    except Exception as e:
-                        print(f"Error setting core property {prop}: {e}")
-                else:
-                    setattr(core_properties, prop, value)
-
-def process_headers_footers(section, headers_data, footers_data):
-    def apply_paragraph_formatting(paragraph, format_data):
-        if format_data:
-            p_format = paragraph.paragraph_format
-            for key, value in format_data.items():
-                if key == 'alignment':
-                    p_format.alignment = getattr(WD_ALIGN_PARAGRAPH, value, WD_ALIGN_PARAGRAPH.LEFT)
-                elif key == 'line_spacing':
-                    p_format.line_spacing = value
-                elif key == 'line_spacing_rule':
-                    p_format.line_spacing_rule = getattr(WD_LINE_SPACING, value, WD_LINE_SPACING.SINGLE)
-                elif key == 'first_line_indent':
-                    p_format.first_line_indent = Inches(value)
-                elif key == 'left_indent':
-                    p_format.left_indent = Inches(value)
-                elif key == 'right_indent':
-                    p_format.right_indent = Inches(value)
-                elif key == 'space_before':
-                    p_format.space_before = Pt(value)
-                elif key == 'space_after':
-                    p_format.space_after = Pt(value)
-                elif key == 'keep_together':
-                    p_format.keep_together = value
-                elif key == 'keep_with_next':
-                    p_format.keep_with_next = value
-                elif key == 'page_break_before':
-                    p_format.page_break_before = value
-                elif key == 'widow_control':
-                    p_format.widow_control = value
-                elif key == 'tab_stops':
-                    for tab_stop in value:
-                        p_format.tab_stops.add_tab_stop(
-                            Inches(tab_stop.get('position', 0)),
-                            alignment=getattr(WD_TAB_ALIGNMENT, tab_stop.get('alignment', 'LEFT'), WD_TAB_ALIGNMENT.LEFT),
-                            leader=getattr(WD_TAB_LEADER, tab_stop.get('leader', 'SPACES'), WD_TAB_LEADER.SPACES)
-                        )
-    def apply_font_formatting(paragraph, font_data):
-        if font_data:
-            if not paragraph.runs:
-                paragraph.add_run()
-            font = paragraph.runs[0].font
-            for font_key, font_value in font_data.items():
-                if font_key == 'color':
-                    if isinstance(font_value, str) and font_value.startswith('#'):
-                        try:
-                            rgb = RGBColor.from_string(font_value[1:])
-                            font.color.rgb = rgb
-                        except ValueError:
-                            print(f"Invalid color format: {font_value}. Skipping.")
-                    else:
-                        print(f"Invalid color format: {font_value}. Skipping.")
-                elif font_key == 'size':
-                    font.size = Pt(font_value)
-                elif hasattr(font, font_key):
-                    setattr(font, font_key, font_value)
-
-    if headers_data:
-        for header_type, header_content in headers_data.items():
-            if header_type == "FIRST":
-                header = section.first_page_header
-            elif header_type == "EVEN":
-                header = section.even_page_header
-            else:
-                header = section.header
-
-            if header:
-                header.is_linked_to_previous = False
-                if header.paragraphs:
-                    paragraph = header.paragraphs[0]
-                    paragraph.text = header_content
-                else:
-                    paragraph = header.add_paragraph(header_content)
-
-                apply_paragraph_formatting(paragraph, headers_data.get('paragraph_format'))
-                if 'font' in headers_data:
-                    apply_font_formatting(paragraph, paragraph)
-
-    if footers_data:
-        for footer_type, footer_content in footers_data.items():
-            if footer_type == "FIRST":
-                footer = section.first_page_footer
-            elif footer_type == "EVEN":
-                footer = section.even_page_footer
-            else:
-                footer = section.footer
-
-            if footer:
-                footer.is_linked_to_previous = False
-                if footer.paragraphs:
-                    paragraph = footer.paragraphs[0]
-                    paragraph.text = footer_content
-                else:
-                    paragraph = header.add_paragraph(header_content)
-                if 'paragraph_format' in footers_data:
-                    apply_paragraph_formatting(paragraph, footers_data['paragraph_format'])
-                if 'font' in footers_data:
-                    apply_font_formatting(paragraph, paragraph)
-
-def process_sections(document, sections_data, default_page_width, default_page_height,
-                     default_left_margin, default_right_margin, default_top_margin,
-                     default_bottom_margin, default_gutter, default_header_distance,
-                     default_footer_distance, default_orientation):
-    for section_data in sections_data:
-        section = document.add_section(start_type=getattr(WD_SECTION_START, section_data.get('start_type', 'NEW_PAGE'), WD_SECTION_START.NEW_PAGE))
-        section.orientation = getattr(WD_ORIENTATION, section_data.get('orientation', default_orientation), WD_ORIENTATION.PORTRAIT)
-        section.page_width = Inches(section_data.get('page_width', default_page_width))
-        section.page_height = Inches(section_data.get('page_height', default_page_height))
-        section.left_margin = Inches(section_data.get('left_margin', default_left_margin))
-        section.right_margin = Inches(section_data.get('right_margin', default_right_margin))
-        section.top_margin = Inches(section_data.get('top_margin', default_top_margin))
-        section.bottom_margin = Inches(section_data.get('bottom_margin', default_bottom_margin))
-        section.gutter = Inches(section_data.get('gutter', default_gutter))
-        section.header_distance = Inches(section_data.get('header_distance', default_header_distance))
-        section.footer_distance = Inches(section_data.get('footer_distance', default_footer_distance))
-        process_headers_footers(section, section_data.get('headers'), section_data.get('footers'))
-
-def process_paragraph(document, item):
-    style_name = item.get('style')
-    style = None
-    if style_name:
+artifact_store = create_artifact_store()
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+DOCX_MAX_CONTENT_ITEMS = int(os.environ.get('DOCX_MAX_CONTENT_ITEMS', 10000))
+
+class TooManyContentItems(ValueError):
+    pass
+
+# python-docx (docx_renderer, docx_templates) is imported on first use rather than
+# here, so workers that never render a document do not pay for it.
+
+# Opt-in asynchronous rendering ("asyncMode": "true"). Rendering is CPU-bound, so
+# jobs run in a small process pool rather than in threads.
+DOCX_JOB_WORKERS = int(os.environ.get('DOCX_JOB_WORKERS', 2))
+DOCX_JOB_MAX_QUEUE = int(os.environ.get('DOCX_JOB_MAX_QUEUE', 16))
+DOCX_JOB_START_METHOD = os.environ.get('DOCX_JOB_START_METHOD', 'spawn')
+# Job state lives in the artifact index, written by the job process itself, so any
+# worker can answer a status poll and jobs outlive the worker that queued them.
+# The futures are only kept to bound this worker's queue.
+_docx_job_futures = set()
+_docx_jobs_lock = threading.RLock()
+_docx_job_executor = None
+_docx_job_executor_pid = None
+
+def _render_docx_job(data, job_id, file_id, temp_file_path):
+    # Runs in a DOCX job worker process.
+    artifact_store.update_job(job_id, 'running', pid=os.getpid())
+    try:
+        from docx_renderer import build_document
+        document = build_document(data)
+        with stage('save'):
+            document.save(temp_file_path)
+        artifact_store.add(temp_file_path, file_id=file_id)
+    except Exception as e:
+        artifact_store.update_job(job_id, 'failed', error=str(e))
+        raise
+    artifact_store.update_job(job_id, 'done')
+
+def _docx_job_pool(replace=False):
+    global _docx_job_executor, _docx_job_executor_pid
+    with _docx_jobs_lock:
+        if replace and _docx_job_executor_pid == os.getpid():
+            # A job process died (e.g. killed for running out of memory), which breaks the whole pool.
+            logging.warning("DOCX job pool is broken; starting a new one.")
+            _docx_job_executor.shutdown(wait=False)
+        if replace or _docx_job_executor is None or _docx_job_executor_pid != os.getpid():
+            context = multiprocessing.get_context(DOCX_JOB_START_METHOD)
+            _docx_job_executor = ProcessPoolExecutor(max_workers=DOCX_JOB_WORKERS, mp_context=context)
+            _docx_job_executor_pid = os.getpid()
+            _docx_job_futures.clear()
+        return _docx_job_executor
+
+def _finish_docx_job(job_id, future):
+    # The job marks itself done or failed, unless its process died or never ran it.
+    if not future.cancelled() and future.exception() is None:
+        return
+    try:
+        job = artifact_store.get_job(job_id)
+        if job is not None and job['status'] in ('queued', 'running'):
+            error = 'Job was cancelled.' if future.cancelled() else f"Job process failed: {future.exception()}"
+            artifact_store.update_job(job_id, 'failed', error=error)
+    except Exception as e:
+        logging.warning(f"Could not record the failure of DOCX job {job_id}: {e}")
+
+def submit_docx_job(data):
+    """Queue ``data`` for rendering in the job pool. Returns the job id, or None if the queue is full."""
+    job_id = str(uuid.uuid4())
+    file_id = str(uuid.uuid4())
+    temp_file_path = artifact_store.new_path()
+
+    with _docx_jobs_lock:
+        pool = _docx_job_pool()
+        for future in [future for future in _docx_job_futures if future.done()]:
+            _docx_job_futures.discard(future)
+        if len(_docx_job_futures) >= DOCX_JOB_MAX_QUEUE:
+            return None
+        artifact_store.create_job(job_id, file_id, os.getpid())
         try:
-            style = document.styles[style_name]
-        except KeyError:
-            print(f"Style '{style_name}' not found. Using default style.")
-    paragraph = document.add_paragraph(item.get('text', ''), style=style)
-    if 'paragraph_format' in item:
-        p_format = paragraph.paragraph_format
-        for key, value in item['paragraph_format'].items():
-            if key == 'alignment':
-                p_format.alignment = getattr(WD_ALIGN_PARAGRAPH, value, WD_ALIGN_PARAGRAPH.LEFT)
-            elif key == 'line_spacing':
-                p_format.line_spacing = value
-            elif key == 'line_spacing_rule':
-                p_format.line_spacing_rule = getattr(WD_LINE_SPACING, value, WD_LINE_SPACING.SINGLE)
-            elif key == 'first_line_indent':
-                p_format.first_line_indent = Inches(value)
-            elif key == 'left_indent':
-                p_format.left_indent = Inches(value)
-            elif key == 'right_indent':
-                p_format.right_indent = Inches(value)
-            elif key == 'space_before':
-                p_format.space_before = Pt(value)
-            elif key == 'space_after':
-                p_format.space_after = Pt(value)
-            elif key == 'keep_together':
-                p_format.keep_together = value
-            elif key == 'keep_with_next':
-                p_format.keep_with_next = value
-            elif key == 'page_break_before':
-                p_format.page_break_before = value
-            elif key == 'widow_control':
-                p_format.widow_control = value
-            elif key == 'tab_stops':
-                for tab_stop in value:
-                    p_format.tab_stops.add_tab_stop(
-                        Inches(tab_stop.get('position', 0)),
-                        alignment=getattr(WD_TAB_ALIGNMENT, tab_stop.get('alignment', 'LEFT'), WD_TAB_ALIGNMENT.LEFT),
-                        leader=getattr(WD_TAB_LEADER, tab_stop.get('leader', 'SPACES'), WD_TAB_LEADER.SPACES)
-                    )
-    if 'runs' in item:
-        for run_data in item['runs']:
-            run = paragraph.add_run(run_data.get('text', ''))
-            if 'font' in run_data:
-                font = run.font
-                for font_key, font_value in run_data['font'].items():
-                    if font_key == 'color':
-                        if isinstance(font_value, str) and font_value.startswith('#'):
-                            try:
-                                rgb = RGBColor.from_string(font_value[1:])
-                                font.color.rgb = rgb
-                            except ValueError:
-                                print(f"Invalid color format: {font_value}. Skipping.")
-                        else:
-                            print(f"Invalid color format: {font_value}. Skipping.")
-                    elif font_key == 'size':
-                        font.size = Pt(font_value)
-                    elif hasattr(font, font_key):
-                        setattr(font, font_key, font_value)
-            if 'bold' in run_data:
-                run.bold = run_data['bold']
-            if 'italic' in run_data:
-                run.italic = run_data['italic']
-            if 'underline' in run_data:
-                run.underline = getattr(WD_UNDERLINE, run_data['underline'], WD_UNDERLINE.NONE)
+            try:
+                future = pool.submit(_render_docx_job, data, job_id, file_id, temp_file_path)
+            except BrokenProcessPool:
+                future = _docx_job_pool(replace=True).submit(_render_docx_job, data, job_id, file_id, temp_file_path)
+            future.add_done_callback(lambda future: _finish_docx_job(job_id, future))
+            _docx_job_futures.add(future)
+        except Exception as e:
+            artifact_store.update_job(job_id, 'failed', error=str(e))
+            raise
+    return job_id
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def store_document(document):
+    temp_file_path = artifact_store.new_path()
+    with stage('save'):
+        document.save(temp_file_path)
+    with stage('store'):
+        return artifact_store.add(temp_file_path)
+
+def save_docx_response(document, data):
+    if str(data.get('downloadMode', "link")).lower() == "inline":
+        # Stream the saved package straight out of the buffer instead of
+        # writing it to disk and handing out a link.
+        buffer = io.BytesIO()
+        with stage('save'):
+            document.save(buffer)
+        buffer.seek(0)
+        return send_file(
+            buffer,
+            mimetype=DOCX_MIMETYPE,
+            download_name='generated_document.docx',
+            as_attachment=True
+        )
 
-def process_table(document, item):
-    rows = item.get('rows', 1)
-    cols = item.get('cols', 1)
-    style_name = item.get('style')
-    style = None
-    if style_name:
-        try:
-            style = document.styles[style_name]
-        except KeyError:
-            print(f"Style '{style_name}' not found. Using default style.")
-    table = document.add_table(rows=rows, cols=cols, style=style)
-    if 'alignment' in item:
-        table.alignment = getattr(WD_TABLE_ALIGNMENT, item['alignment'], WD_TABLE_ALIGNMENT.LEFT)
-    if 'table_direction' in item:
-        table.table_direction = getattr(WD_TABLE_DIRECTION, item['table_direction'], WD_TABLE_DIRECTION.LTR)
-    if 'autofit' in item:
-        table.autofit = item['autofit']
-    if 'data' in item:
-        num_rows = min(rows, len(item['data']))
-        for row_idx in range(num_rows):
-            row_data = item['data'][row_idx]
-            num_cols = min(cols, len(row_data))
-            for col_idx in range(num_cols):
-                cell = table.cell(row_idx, col_idx)
-                cell.text = str(row_data[col_idx])
-                if 'vertical_alignment' in item:
-                    cell.vertical_alignment = getattr(WD_CELL_VERTICAL_ALIGNMENT, item['vertical_alignment'], WD_CELL_VERTICAL_ALIGNMENT.TOP)
+    file_id = store_document(document)
 
-def process_image(document, item):
-    try:
-        headers = {"User-Agent": f"Docx_Generator_bot/1.0 requests/{requests.__version__}"}
-        response = requests.get(item['url'], headers=headers, stream=True)
-        response.raise_for_status()
-        image_stream = io.BytesIO(response.content)
-        paragraph = document.add_paragraph()
-        run = paragraph.add_run()
-        width = Inches(item.get('width', 3))
-        height = Inches(item.get('height', 2))
-        run.add_picture(image_stream, width=width, height=height)
-    except Exception as e:
-        print(f"Error adding image: {e}")
+    download_link = url_for('generate_docx.download_file', file_id=file_id, _external=True)
+
+    return jsonify({'download_link': download_link})
 
 @generate_docx_bp.route('/generate_docx', methods=['POST', 'OPTIONS'])
 def generate_docx():
@@ -262,91 +146,86 @@ def generate_docx():
         return jsonify({'status': 'OK'}), 200
 
     try:
+        if request.mimetype == 'application/x-ndjson':
+            from docx_renderer import build_document_from_ndjson
+            with stage('render'):
+                document, data = build_document_from_ndjson(request.stream)
+            if document is None:
+                return jsonify({'error': 'Invalid input. Must provide document parameters.'}), 400
+            return save_docx_response(document, data)
+
         data = request.get_json()
         if not data:
             return jsonify({'error': 'Invalid input. Must provide document parameters.'}), 400
-
-        default_page_width = data.get('defaultPageWidth', 8.5)
-        default_page_height = data.get('defaultPageHeight', 11)
-        default_left_margin = data.get('defaultLeftMargin', 1)
-        default_right_margin = data.get('defaultRightMargin', 1)
-        default_top_margin = data.get('defaultTopMargin', 1)
-        default_bottom_margin = data.get('defaultBottomMargin', 1)
-        default_gutter = data.get('defaultGutter', 0)
-        default_header_distance = data.get('defaultHeaderDistance', 0.5)
-        default_footer_distance = data.get('defaultFooterDistance', 0.5)
-        default_orientation = data.get('defaultOrientation', "PORTRAIT")
-        enable_core_properties = data.get('enableCoreProperties', "false") == "true"
-        core_properties_title = data.get('corePropertiesTitle', "")
-        core_properties_author = data.get('corePropertiesAuthor', "")
-        core_properties_created = data.get('corePropertiesCreated', "")
-        odd_and_even_pages_header_footer = data.get('oddAndEvenPagesHeaderFooter', "false") == "true"
-
-        document = Document()
-        settings = document.settings
-        settings.odd_and_even_pages_header_footer = odd_and_even_pages_header_footer
-
-        if enable_core_properties:
-            core_properties = document.core_properties
-            core_properties_data = {}
-            if core_properties_title:
-                core_properties_data['title'] = core_properties_title
-            if core_properties_author:
-                core_properties_data['author'] = core_properties_author
-            if core_properties_created:
-                core_properties_data['created'] = core_properties_created
-            process_core_properties(core_properties_data, core_properties)
-
-        process_sections(document, data.get('sections', []), default_page_width, default_page_height,
-                         default_left_margin, default_right_margin, default_top_margin,
-                         default_bottom_margin, default_gutter, default_header_distance,
-                         default_footer_distance, default_orientation)
-
-        content = data.get('content', [])
-        for item in content:
-            if item['type'] == 'heading':
-                document.add_heading(item.get('text', ''), level=item.get('level', 1))
-            elif item['type'] == 'paragraph':
-                process_paragraph(document, item)
-            elif item['type'] == 'table':
-                process_table(document, item)
-            elif item['type'] == 'image':
-                process_image(document, item)
-            elif item['type'] == 'list':
-                list_style = item.get('numbering_style') or item.get('style', 'List Bullet')
-                for list_item in item.get('items', []):
-                    document.add_paragraph(list_item, style=list_style)
-            elif item['type'] == 'page_break':
-                document.add_page_break()
-
-        buffer = io.BytesIO()
-        document.save(buffer)
-        buffer.seek(0)
-
-        filename = f"document_{uuid.uuid4()}.docx"
-        temp_file_path = os.path.join("/tmp", filename)
-        with open(temp_file_path, 'wb') as f:
-            f.write(buffer.read())
-
-        file_id = str(uuid.uuid4())
-        generated_files[file_id] = temp_file_path
-
-        download_link = url_for('generate_docx.download_file', file_id=file_id, _external=True)
-
-        return jsonify({'download_link': download_link})
-
+        if len(data.get('content', [])) > DOCX_MAX_CONTENT_ITEMS:
+            raise TooManyContentItems(f"At most {DOCX_MAX_CONTENT_ITEMS} content items are allowed.")
+
+        if str(data.get('asyncMode', "false")).lower() == "true":
+            job_id = submit_docx_job(data)
+            if job_id is None:
+                return jsonify({'error': 'Too many documents are being generated. Please retry later.'}), 429
+            status_url = url_for('generate_docx.docx_job_status', job_id=job_id, _external=True)
+            return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url}), 202
+
+        from docx_renderer import build_document
+        document = build_document(data)
+        return save_docx_response(document, data)
+
+    except (RequestEntityTooLarge, TooManyContentItems) as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@generate_docx_bp.route('/generate_docx/jobs/<job_id>')
+def docx_job_status(job_id):
+    job = artifact_store.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    response = {'job_id': job_id, 'status': job['status']}
+    if job['status'] in ('queued', 'running') and not _process_alive(job['pid']):
+        # The worker that queued it, or the job process rendering it, is gone.
+        response['status'] = 'failed'
+        response['error'] = 'Job was lost when its worker exited. Please submit it again.'
+    elif job['status'] == 'failed':
+        response['error'] = job['error']
+    elif job['status'] == 'done':
+        response['download_link'] = url_for('generate_docx.download_file', file_id=job['file_id'], _external=True)
+    return jsonify(response)
+
+@generate_docx_bp.route('/generate_docx/templates', methods=['GET'])
+def docx_templates_list():
+    from docx_templates import list_templates
+    return jsonify({'templates': list_templates()})
+
+@generate_docx_bp.route('/generate_docx/templates/<template_id>', methods=['PUT'])
+def docx_template_upload(template_id):
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+    from docx_templates import save_template
+    raw = request.files['file'].read() if 'file' in request.files else request.get_data()
+    if not raw:
+        return jsonify({'error': 'No template file provided.'}), 400
+    try:
+        save_template(template_id, raw)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'template_id': template_id}), 201
+
 @generate_docx_bp.route('/download/<file_id>')
 def download_file(file_id):
-    if file_id in generated_files:
-        temp_file_path = generated_files[file_id]
+    temp_file_path = artifact_store.get(file_id)
+    if temp_file_path:
+        # conditional/etag enable If-None-Match and Range requests; file
+        # responses go out through wsgi.file_wrapper, which gunicorn serves with sendfile().
         return send_file(
             temp_file_path,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            mimetype=DOCX_MIMETYPE,
             download_name='generated_document.docx',
-            as_attachment=True
+            as_attachment=True,
+            conditional=True,
+            etag=True
         )
     else:
         return "File not found", 404
@@ -0,0 +1,113 @@
+"""Gunicorn settings: ``gunicorn -c gunicorn.conf.py wsgi:application``.
+
+Worker and thread counts are derived from the CPUs and memory available to the
+container (cgroup limits included). Every value can be overridden with the
+GUNICORN_* environment variables documented in the README, or on the command line.
+"""
+import gc
+import importlib.util
+import logging
+import math
+import os
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def available_cpus():
+    """CPUs this process may use: the affinity mask, further capped by a cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if quota and not quota.startswith('max'):
+        limit, period = quota.split()[:2]
+        cpus = min(cpus, int(limit) / int(period))
+    else:
+        limit = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if limit and period and int(limit) > 0:
+            cpus = min(cpus, int(limit) / int(period))
+    return max(1, math.ceil(cpus))
+
+
+def available_memory():
+    """Bytes of memory this process may use: physical memory, capped by a cgroup memory limit."""
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        memory = None
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = _read_first_line(path)
+        # cgroup v1 reports "no limit" as a huge number.
+        if limit and limit.isdigit() and int(limit) < 1 << 60:
+            memory = int(limit) if memory is None else min(memory, int(limit))
+            break
+    return memory
+
+
+CPUS = available_cpus()
+MEMORY = available_memory()
+# Resident size of a worker that has rendered documents (python-docx and lxml loaded).
+WORKER_MEMORY_MB = int(os.environ.get('GUNICORN_WORKER_MEMORY_MB', 200))
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Only look gevent up: importing it here, before the worker patches the standard library, would break it.
+if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+    logging.getLogger('gunicorn.error').warning("GUNICORN_WORKER_CLASS=gevent but gevent is not installed; using gthread.")
+    worker_class = 'gthread'
+
+# The usual 2 x CPUs + 1, but no more than fit in memory next to the master.
+_cpu_workers = 2 * CPUS + 1
+_memory_workers = max(1, int((MEMORY / 1024 ** 2 - WORKER_MEMORY_MB) // WORKER_MEMORY_MB)) if MEMORY else _cpu_workers
+workers = int(os.environ.get('GUNICORN_WORKERS') or min(_cpu_workers, _memory_workers))
+
+# Brave and Vectorize requests mostly wait on the network, so each worker serves
+# several at once; document rendering holds the GIL, so more threads stop helping.
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+# Load the app once in the master so forked workers share its memory copy-on-write.
+# With preload, python-docx and the default template are loaded up front too
+# (DOCX_PRELOAD), instead of separately in every worker. Not for gevent: the master
+# would import ssl and create threading locks before the worker monkey-patches them.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'false' if worker_class == 'gevent' else 'true').lower() == 'true'
+if preload_app and worker_class == 'gevent':
+    logging.getLogger('gunicorn.error').warning(
+        "GUNICORN_PRELOAD=true with gevent workers: modules imported before monkey-patching may break HTTPS.")
+if preload_app:
+    os.environ.setdefault('DOCX_PRELOAD', 'true')
+
+# Recycle workers to cap memory creep from python-docx/lxml; the jitter keeps
+# workers from restarting all at once. Asynchronous DOCX jobs keep their state in
+# the artifact index, so any worker can still report on a recycled worker's jobs,
+# as failed if they could not finish.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10))
+
+# Long enough for a large document or a slow upstream (timeouts plus retries).
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Worker heartbeats go to memory rather than a possibly slow container disk.
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def when_ready(server):
+    cfg = server.cfg
+    server.log.info(
+        f"{cfg.workers} {cfg.worker_class_str} workers, {cfg.threads} threads each "
+        f"({CPUS} CPUs, {MEMORY // 1024 ** 2 if MEMORY else 'unknown'} MB memory), preload {cfg.preload_app}"
+    )
+    if cfg.preload_app:
+        # Objects loaded so far are never collected; the collector then leaves their
+        # pages alone, so they stay shared between the forked workers.
+        gc.freeze()
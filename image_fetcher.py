@@ -0,0 +1,269 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import upstream_client
+from metrics import record_upstream_bytes
+
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get('IMAGE_FETCH_CONCURRENCY', 8))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', 10))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_CACHE_ENABLED = os.environ.get('IMAGE_CACHE_ENABLED', 'true').lower() == 'true'
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '/tmp/docx_image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Cached images younger than this are used without asking the origin whether they changed.
+IMAGE_CACHE_REVALIDATE_AFTER = float(os.environ.get('IMAGE_CACHE_REVALIDATE_AFTER', 300))
+# The cache directory is scanned for eviction at most this often, unless this
+# worker's own writes take it over IMAGE_CACHE_MAX_BYTES sooner.
+IMAGE_CACHE_EVICT_INTERVAL = float(os.environ.get('IMAGE_CACHE_EVICT_INTERVAL', 60))
+USER_AGENT = f"Docx_Generator_bot/1.0 requests/{requests.__version__}"
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class ImageCache:
+    """Content-addressed on-disk image cache with LRU eviction.
+
+    ``blobs/`` holds image bytes named by their sha256, so the same logo served
+    from several URLs is stored once. ``index/`` maps each URL to its blob and
+    the ETag/Last-Modified validators used to revalidate it.
+    """
+
+    def __init__(self, root, max_bytes, evict_interval):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.index_dir = os.path.join(root, 'index')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._evict_lock = threading.Lock()
+        # Size found by the last scan plus what this process has written since.
+        self._estimated_bytes = None
+        self._scanned_at = 0
+
+    def _index_path(self, url):
+        return os.path.join(self.index_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def lookup(self, url):
+        index_path = self._index_path(url)
+        try:
+            with open(index_path) as f:
+                entry = json.load(f)
+            blob_path = os.path.join(self.blob_dir, entry['blob'])
+            with open(blob_path, 'rb') as f:
+                content = f.read()
+            os.utime(blob_path)
+        except FileNotFoundError:
+            self._remove(index_path)
+            return None, None
+        except (OSError, ValueError, KeyError):
+            return None, None
+        return entry, content
+
+    def touch(self, url, entry):
+        entry['checked_at'] = time.time()
+        self._write_index(url, entry)
+
+    def store(self, url, content, etag, last_modified):
+        blob = hashlib.sha256(content).hexdigest()
+        blob_path = os.path.join(self.blob_dir, blob)
+        if not os.path.exists(blob_path):
+            tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, blob_path)
+            with self._evict_lock:
+                if self._estimated_bytes is not None:
+                    self._estimated_bytes += len(content)
+        else:
+            os.utime(blob_path)
+        self._write_index(url, {
+            'blob': blob,
+            'etag': etag,
+            'last_modified': last_modified,
+            'checked_at': time.time(),
+        })
+        self.maybe_evict()
+
+    def _write_index(self, url, entry):
+        index_path = self._index_path(url)
+        tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, index_path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+    def maybe_evict(self):
+        with self._evict_lock:
+            due = (self._estimated_bytes is None or self._estimated_bytes > self.max_bytes
+                   or time.monotonic() - self._scanned_at >= self.evict_interval)
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used blobs, and the index entries pointing at them, beyond ``max_bytes``."""
+        with self._evict_lock:
+            blobs = []
+            total = 0
+            for entry in os.scandir(self.blob_dir):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.name))
+                total += stat.st_size
+            evicted = set()
+            if total > self.max_bytes:
+                # Leave some room, so the next few images do not need another scan.
+                target = self.max_bytes * 0.9
+                for _, size, name in sorted(blobs):
+                    if not self._remove(os.path.join(self.blob_dir, name)):
+                        continue
+                    evicted.add(name)
+                    total -= size
+                    if total <= target:
+                        break
+            self._estimated_bytes = total
+            self._scanned_at = time.monotonic()
+        if evicted:
+            self._remove_index_entries(evicted)
+
+    def _remove_index_entries(self, blobs):
+        for entry in os.scandir(self.index_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    blob = json.load(f).get('blob')
+            except (OSError, ValueError, AttributeError):
+                continue
+            if blob in blobs:
+                self._remove(entry.path)
+
+
+_cache = None
+
+
+def _image_cache():
+    global _cache
+    if _cache is None and IMAGE_CACHE_ENABLED:
+        try:
+            _cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_EVICT_INTERVAL)
+        except OSError as e:
+            logging.warning(f"Image cache disabled, could not create {IMAGE_CACHE_DIR}: {e}")
+    return _cache
+
+
+def begin_image_fetch(url):
+    """Check the cache for ``url``.
+
+    Returns ``(cached_content, entry, headers)``. When the cached copy is still
+    fresh, ``headers`` is None and no request is needed; otherwise ``headers``
+    holds the request headers, including validators for a conditional GET.
+    """
+    cache = _image_cache()
+    entry, cached_content = cache.lookup(url) if cache else (None, None)
+    if cached_content is not None and time.time() - entry.get('checked_at', 0) < IMAGE_CACHE_REVALIDATE_AFTER:
+        return cached_content, entry, None
+
+    headers = {"User-Agent": USER_AGENT}
+    if cached_content is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return cached_content, entry, headers
+
+
+def image_not_modified(url, entry):
+    try:
+        _image_cache().touch(url, entry)
+    except OSError as e:
+        logging.warning(f"Could not update cached image {url}: {e}")
+
+
+def remember_image(url, content, etag, last_modified):
+    record_upstream_bytes('image', len(content))
+    cache = _image_cache()
+    if cache:
+        try:
+            cache.store(url, content, etag, last_modified)
+        except OSError as e:
+            logging.warning(f"Could not cache image {url}: {e}")
+
+
+def check_declared_size(headers):
+    declared = headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > IMAGE_MAX_BYTES:
+        raise ImageTooLarge(f"Image is {declared} bytes, limit is {IMAGE_MAX_BYTES}")
+
+
+def _read_limited(response, deadline):
+    check_declared_size(response.headers)
+    chunks = []
+    received = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        received += len(chunk)
+        if received > IMAGE_MAX_BYTES:
+            raise ImageTooLarge(f"Image exceeds {IMAGE_MAX_BYTES} bytes")
+        if time.monotonic() > deadline:
+            raise requests.exceptions.Timeout(f"Image download took longer than {IMAGE_FETCH_TIMEOUT}s")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def fetch_image(url):
+    """Return the bytes of the image at ``url``, using the disk cache when possible."""
+    cached_content, entry, headers = begin_image_fetch(url)
+    if headers is None:
+        return cached_content
+
+    deadline = time.monotonic() + IMAGE_FETCH_TIMEOUT
+    with upstream_client.get(url, headers=headers, stream=True,
+                             timeout=(upstream_client.CONNECT_TIMEOUT, IMAGE_FETCH_TIMEOUT)) as response:
+        if response.status_code == 304 and cached_content is not None:
+            image_not_modified(url, entry)
+            return cached_content
+        response.raise_for_status()
+        content = _read_limited(response, deadline)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    remember_image(url, content, etag, last_modified)
+    return content
+
+
+def fetch_images(urls):
+    """Fetch ``urls`` concurrently. Maps each URL to its bytes or to the exception it raised."""
+    unique_urls = list(dict.fromkeys(urls))
+    results = {}
+    if not unique_urls:
+        return results
+
+    def fetch(url):
+        try:
+            return fetch_image(url)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(len(unique_urls), IMAGE_FETCH_CONCURRENCY)) as executor:
+        for url, outcome in zip(unique_urls, executor.map(fetch, unique_urls)):
+            results[url] = outcome
+    return results
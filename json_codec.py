@@ -0,0 +1,76 @@
+"""JSON encoding and decoding through orjson when it is installed, else the standard library."""
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.environ.get('ORJSON_ENABLED', 'true').lower() != 'true':
+    orjson = None
+
+
+def loads(data):
+    """Parse JSON from bytes or str. Raises ValueError on invalid input."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, sort_keys=False):
+    """Serialize ``obj`` to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            # Values orjson rejects (non-str keys, integers over 64 bits, ...).
+            pass
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def escape_string(text):
+    """``text`` as the inside of a JSON string literal, for writing a string value in pieces."""
+    return dumps(text)[1:-1]
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that uses orjson for request parsing and jsonify when it can."""
+
+    def _orjson_option(self, indent=None):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return option | orjson.OPT_INDENT_2 if indent else option
+
+    def dumps(self, obj, **kwargs):
+        # Compact separators and an indent of 2 are what orjson produces anyway;
+        # anything else needs the stdlib encoder.
+        indent = kwargs.pop('indent', None)
+        separators = kwargs.pop('separators', None)
+        if orjson is None or kwargs or indent not in (None, 2) or separators not in (None, (',', ':')):
+            if indent is not None:
+                kwargs['indent'] = indent
+            if separators is not None:
+                kwargs['separators'] = separators
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._orjson_option(indent)).decode('utf-8')
+        except TypeError:
+            return super().dumps(obj, indent=indent, separators=separators)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._orjson_option(indent) | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
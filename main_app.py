@@ -1,10 +1,28 @@
+import os
 from flask import Flask
+from json_codec import FastJSONProvider
 from brave_search import brave_search_bp
 from vectorize_query import vectorize_query_bp
 from generate_docx import generate_docx_bp
+from metrics import metrics_bp
+from request_profiler import PROFILER_ENABLED, install_profiler, profiler_bp
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+# Request bodies larger than this are rejected with 413 before they are parsed.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
 
 app.register_blueprint(brave_search_bp, url_prefix='/')
 app.register_blueprint(vectorize_query_bp, url_prefix='/')
 app.register_blueprint(generate_docx_bp, url_prefix='/')
+app.register_blueprint(metrics_bp, url_prefix='/')
+app.register_blueprint(profiler_bp, url_prefix='/')
+
+if PROFILER_ENABLED:
+    install_profiler(app)
+
+# python-docx is normally imported on the first /generate_docx request. With DOCX_PRELOAD
+# it is loaded here instead, so workers forked by `gunicorn --preload` share it copy-on-write.
+if os.environ.get('DOCX_PRELOAD', 'false').lower() == 'true':
+    import docx_renderer
+    docx_renderer.preload()
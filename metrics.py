@@ -0,0 +1,346 @@
+import atexit
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, g, request
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# Every worker process writes its counters to its own file here; /metrics adds them up.
+METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/plugin_server_metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# Counters and histograms of exited workers, folded together so their files can be deleted.
+CUMULATIVE_FILE = 'metrics_cumulative.json'
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_DESCRIPTIONS = {
+    'plugin_requests_total': ('counter', 'Requests handled, by route, method and status code.'),
+    'plugin_request_duration_seconds': ('histogram', 'Request latency by route.'),
+    'plugin_stage_duration_seconds': ('histogram', 'Time spent in each processing stage, by route.'),
+    'plugin_upstream_bytes_total': ('counter', 'Response bytes received from upstream services.'),
+    'plugin_upstream_requests_total': ('counter', 'Upstream calls by outcome (success, failure, or rejected by an open circuit breaker).'),
+    'plugin_upstream_hedges_total': ('counter', 'Hedged second attempts fired, by which attempt answered first.'),
+    'plugin_circuit_breaker_transitions_total': ('counter', 'Circuit breaker state changes, by new state.'),
+    'plugin_circuit_breakers_open': ('gauge', 'Circuit breakers currently open, summed over live workers.'),
+    'plugin_background_refresh_total': ('counter', 'Background cache refreshes by trigger (stale hit or prefetch) and outcome.'),
+    'plugin_background_refreshes_in_flight': ('gauge', 'Background cache refreshes currently running, summed over live workers.'),
+    'plugin_rate_limit_total': ('counter', 'Rate-limited upstream calls by outcome (allowed, queued then allowed, or rejected).'),
+}
+
+metrics_bp = Blueprint('metrics', __name__)
+
+_current_request = contextvars.ContextVar('metrics_current_request', default=None)
+
+
+class MetricsRegistry:
+    """Counters and histograms of one worker process, periodically written to ``directory``."""
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self._reset()
+
+    def _reset(self):
+        # Also called in a forked worker, so it never reports its parent's numbers.
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.dirty = False
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, f"metrics_{self.pid}_{time.time_ns()}.json")
+        self._flusher = None
+
+    def _check_process(self):
+        if self.pid != os.getpid():
+            self._reset()
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_process()
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.dirty = True
+
+    def set_gauge(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_process()
+            self.gauges[key] = value
+            self.dirty = True
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_process()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), histogram['buckets'], histogram['sum'], histogram['count']]
+                               for (name, labels), histogram in self.histograms.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+            }
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty or self.pid != os.getpid():
+                return
+            self.dirty = False
+            path = self.path
+        snapshot = self.snapshot()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {path}: {e}")
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+registry = MetricsRegistry(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+atexit.register(registry.flush)
+
+
+def _label_key(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def _process_alive(file_name):
+    # File names are metrics_<pid>_<ns>.json.
+    try:
+        os.kill(int(file_name.split('_')[1]), 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge_snapshot(snapshot, counters, histograms, gauges=None):
+    if gauges is not None:
+        for name, labels, value in snapshot.get('gauges', []):
+            key = (name, _label_key(labels))
+            gauges[key] = gauges.get(key, 0) + value
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, _label_key(labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, total, count in snapshot.get('histograms', []):
+        key = (name, _label_key(labels))
+        merged = histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], buckets)]
+        merged['sum'] += total
+        merged['count'] += count
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _fold_exited_snapshots():
+    """Add the files of exited processes into the cumulative file and delete them.
+
+    Workers recycled by gunicorn's max_requests would otherwise leave a file each
+    behind. The caller holds the directory lock.
+    """
+    exited = [name for name in os.listdir(METRICS_DIR)
+              if name.startswith('metrics_') and name.endswith('.json')
+              and name != CUMULATIVE_FILE and not _process_alive(name)]
+    if not exited:
+        return
+    counters = {}
+    histograms = {}
+    for name in [CUMULATIVE_FILE] + exited:
+        snapshot = _read_snapshot(os.path.join(METRICS_DIR, name))
+        if snapshot is not None:
+            _merge_snapshot(snapshot, counters, histograms)
+    cumulative = {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), histogram['buckets'], histogram['sum'], histogram['count']]
+                       for (name, labels), histogram in histograms.items()],
+    }
+    path = os.path.join(METRICS_DIR, CUMULATIVE_FILE)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(cumulative, f)
+    os.replace(f"{path}.tmp", path)
+    for name in exited:
+        try:
+            os.remove(os.path.join(METRICS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def aggregate_snapshots():
+    """Sum the snapshots of every worker, using live numbers for the current one.
+
+    Counters and histograms include workers that have exited; gauges only live ones.
+    """
+    counters = {}
+    histograms = {}
+    gauges = {}
+    _merge_snapshot(registry.snapshot(), counters, histograms, gauges)
+    if not os.path.isdir(METRICS_DIR):
+        return counters, histograms, gauges
+    # Scrapes take turns, so none sees a file both folded and not yet deleted.
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            _fold_exited_snapshots()
+        except OSError as e:
+            logging.warning(f"Could not fold metrics of exited workers: {e}")
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if not name.endswith('.json') or path == registry.path:
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                # The cumulative file, and workers that exited since the fold, count
+                # towards counters and histograms only.
+                _merge_snapshot(snapshot, counters, histograms, gauges if _process_alive(name) else None)
+    return counters, histograms, gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics():
+    """Return all metrics in the Prometheus text exposition format."""
+    counters, histograms, gauges = aggregate_snapshots()
+    lines = []
+    for metric, (kind, description) in METRIC_DESCRIPTIONS.items():
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+        if kind in ('counter', 'gauge'):
+            for (name, labels), value in sorted((counters if kind == 'counter' else gauges).items()):
+                if name == metric:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+            continue
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def start_request(route):
+    """Begin timing a request to ``route``. Returns a token for finish_request."""
+    if not METRICS_ENABLED:
+        return None
+    return _current_request.set({'route': route, 'start': time.perf_counter(), 'stages': []})
+
+
+def discard_request(token):
+    """Stop tracking the request started with ``token`` without recording it."""
+    if token is not None:
+        try:
+            _current_request.reset(token)
+        except ValueError:
+            pass
+
+
+def finish_request(token, method, status):
+    """Record the request started with ``token``. Returns its Server-Timing header value, if enabled."""
+    if token is None:
+        return None
+    timings = _current_request.get()
+    try:
+        _current_request.reset(token)
+    except ValueError:
+        # The token was created in another context; nothing to restore.
+        pass
+    if timings is None:
+        return None
+    elapsed = time.perf_counter() - timings['start']
+    registry.inc('plugin_requests_total', {'route': timings['route'], 'method': method, 'status': str(status)})
+    registry.observe('plugin_request_duration_seconds', {'route': timings['route']}, elapsed)
+    if not SERVER_TIMING_ENABLED:
+        return None
+    totals = {}
+    for stage_name, duration in timings['stages']:
+        totals[stage_name] = totals.get(stage_name, 0) + duration
+    entries = [f"{stage_name};dur={duration * 1000:.1f}" for stage_name, duration in totals.items()]
+    entries.append(f"total;dur={elapsed * 1000:.1f}")
+    return ', '.join(entries)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage ``name`` of the current request."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _current_request.get()
+        route = timings['route'] if timings is not None else 'background'
+        registry.observe('plugin_stage_duration_seconds', {'route': route, 'stage': name}, elapsed)
+        if timings is not None:
+            timings['stages'].append((name, elapsed))
+
+
+def record_upstream_bytes(upstream, count):
+    if METRICS_ENABLED:
+        registry.inc('plugin_upstream_bytes_total', {'upstream': upstream}, count)
+
+
+@metrics_bp.before_app_request
+def _start_request_metrics():
+    g.metrics_token = start_request(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+
+
+@metrics_bp.after_app_request
+def _finish_request_metrics(response):
+    server_timing = finish_request(g.pop('metrics_token', None), request.method, response.status_code)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
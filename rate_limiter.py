@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import registry, stage, METRICS_ENABLED
+from response_cache import hash_credential
+
+# Upstream calls are limited per endpoint and credential by a token bucket (rate
+# per second, burst) and a cap on calls in flight. The state lives in SQLite so
+# the limits hold across all gunicorn/uvicorn workers. A call over the limit
+# waits, for up to RATE_LIMIT_MAX_WAIT seconds, before it is rejected.
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_DB_PATH = os.environ.get('RATE_LIMIT_DB_PATH', '/tmp/plugin_server_rate_limits.sqlite3')
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 5))
+# A lease left behind by a worker that died is reclaimed after this many seconds.
+RATE_LIMIT_LEASE_TTL = float(os.environ.get('RATE_LIMIT_LEASE_TTL', 120))
+RATE_LIMIT_POLL_INTERVAL = 0.05
+RATE_LIMITS = {
+    # endpoint: (tokens per second, burst, max in flight); 0 means unlimited.
+    'brave': (float(os.environ.get('RATE_LIMIT_BRAVE_RATE', 20)),
+              float(os.environ.get('RATE_LIMIT_BRAVE_BURST', 20)),
+              int(os.environ.get('RATE_LIMIT_BRAVE_CONCURRENCY', 4))),
+    'vectorize': (float(os.environ.get('RATE_LIMIT_VECTORIZE_RATE', 10)),
+                  float(os.environ.get('RATE_LIMIT_VECTORIZE_BURST', 20)),
+                  int(os.environ.get('RATE_LIMIT_VECTORIZE_CONCURRENCY', 4))),
+}
+IDLE_BUCKET_SECONDS = 3600
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Too many {endpoint} requests for this credential; retry in {retry_after:.1f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        """Value for the Retry-After response header: whole seconds, at least one."""
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class RateLimiter:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, key TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS leases_key ON leases (key)")
+
+    def _connect(self):
+        # sqlite connections must not cross threads or forks.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def try_acquire(self, key, rate, burst, concurrency, reserve=0):
+        """Take a token and an in-flight slot for ``key``. Returns ``(lease_id, None)`` or ``(None, seconds_to_wait)``.
+
+        With ``reserve``, that many tokens and slots must be left over afterwards.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM buckets WHERE updated <= ?", (now - IDLE_BUCKET_SECONDS,))
+            if concurrency and conn.execute("SELECT COUNT(*) FROM leases WHERE key = ?", (key,)).fetchone()[0] + reserve >= concurrency:
+                conn.execute("COMMIT")
+                return None, RATE_LIMIT_POLL_INTERVAL
+            if rate:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                if tokens < 1 + reserve:
+                    conn.execute("COMMIT")
+                    return None, (1 + reserve - tokens) / rate
+                conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens - 1, now))
+            lease_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO leases (id, key, expires_at) VALUES (?, ?, ?)", (lease_id, key, now + RATE_LIMIT_LEASE_TTL))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return lease_id, None
+
+    def release(self, lease_id):
+        self._connect().execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+
+
+_limiter = None
+
+
+def _get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(RATE_LIMIT_DB_PATH)
+    return _limiter
+
+
+def _attempt(endpoint, credential, deadline, reserve):
+    """One acquisition attempt: ``(lease_id, None)``, ``(None, seconds_to_sleep)``, or RateLimitExceeded."""
+    rate, burst, concurrency = RATE_LIMITS[endpoint]
+    try:
+        lease_id, wait = _get_limiter().try_acquire(f"{endpoint}:{hash_credential(credential)}", rate, burst, concurrency, reserve)
+    except sqlite3.Error as e:
+        # Never fail a request because the limiter's database is unavailable.
+        logging.warning(f"Rate limiter unavailable, not limiting: {e}")
+        return None, None
+    if lease_id is not None:
+        return lease_id, None
+    remaining = deadline - time.monotonic()
+    if wait > remaining:
+        raise RateLimitExceeded(endpoint, wait)
+    return None, wait
+
+
+def _release(lease_id):
+    if lease_id is None:
+        return
+    try:
+        _get_limiter().release(lease_id)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not release rate limit lease: {e}")
+
+
+def _count(endpoint, outcome):
+    if METRICS_ENABLED:
+        registry.inc('plugin_rate_limit_total', {'endpoint': endpoint, 'outcome': outcome})
+
+
+def _is_active(endpoint):
+    return RATE_LIMIT_ENABLED and any(RATE_LIMITS[endpoint][index] for index in (0, 2))
+
+
+@contextmanager
+def limit(endpoint, credential, max_wait=None, reserve=0):
+    """Hold one of ``credential``'s rate-limited slots for ``endpoint`` while the block runs.
+
+    Waits at most ``max_wait`` seconds (default RATE_LIMIT_MAX_WAIT) for a slot. Background
+    work passes ``reserve=1`` so it only runs while live requests still have room.
+    """
+    lease_id = None
+    if _is_active(endpoint):
+        deadline = time.monotonic() + (RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait)
+        outcome = 'allowed'
+        with stage('queue'):
+            while True:
+                try:
+                    lease_id, wait = _attempt(endpoint, credential, deadline, reserve)
+                except RateLimitExceeded:
+                    _count(endpoint, 'rejected')
+                    raise
+                if wait is None:
+                    break
+                outcome = 'queued'
+                time.sleep(wait)
+        _count(endpoint, outcome)
+    try:
+        yield
+    finally:
+        _release(lease_id)
+
+
+@asynccontextmanager
+async def limit_async(endpoint, credential, max_wait=None, reserve=0):
+    """limit() for the event loop: waiting yields to other requests."""
+    lease_id = None
+    if _is_active(endpoint):
+        deadline = time.monotonic() + (RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait)
+        outcome = 'allowed'
+        with stage('queue'):
+            while True:
+                try:
+                    # The sqlite transaction can wait up to its busy timeout, so it runs off the event loop.
+                    lease_id, wait = await asyncio.to_thread(_attempt, endpoint, credential, deadline, reserve)
+                except RateLimitExceeded:
+                    _count(endpoint, 'rejected')
+                    raise
+                if wait is None:
+                    break
+                outcome = 'queued'
+                await asyncio.sleep(wait)
+        _count(endpoint, outcome)
+    try:
+        yield
+    finally:
+        if lease_id is not None:
+            await asyncio.to_thread(_release, lease_id)
@@ -0,0 +1,248 @@
+import cProfile
+import json
+import logging
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import Blueprint, g, jsonify, request, send_file
+
+from admin_auth import check_admin_token
+
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() == 'true'
+# "sampling" (periodic stack samples, low overhead) or "cprofile" (deterministic, exact call counts).
+PROFILER_MODE = os.environ.get('PROFILER_MODE', 'sampling').lower()
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0.0))
+PROFILER_THRESHOLD_MS = float(os.environ.get('PROFILER_THRESHOLD_MS', 1000))
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+PROFILER_KEEP = int(os.environ.get('PROFILER_KEEP', 20))
+# Profiles are kept on disk so every worker can serve them.
+PROFILER_DIR = os.environ.get('PROFILER_DIR', '/tmp/plugin_server_profiles')
+PROFILE_ID_LENGTH = 32
+
+profiler_bp = Blueprint('request_profiler', __name__)
+
+
+class StackSampler:
+    """Samples the Python stacks of registered threads from one background thread."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.thread = None
+
+    def start(self, thread_id):
+        with self.lock:
+            self.active[thread_id] = {'start': time.perf_counter(), 'samples': [], 'weights': [], 'last': time.perf_counter()}
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def stop(self, thread_id):
+        with self.lock:
+            return self.active.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                for thread_id, recording in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.reverse()
+                    recording['samples'].append(stack)
+                    recording['weights'].append(now - recording['last'])
+                    recording['last'] = now
+
+
+_sampler = StackSampler(PROFILER_INTERVAL_MS / 1000)
+
+
+def speedscope_profile(recording, name, duration):
+    """Convert a StackSampler recording into a speedscope "sampled" profile."""
+    frame_index = {}
+    frames = []
+    samples = []
+    for stack in recording['samples']:
+        indices = []
+        for frame in stack:
+            index = frame_index.get(frame)
+            if index is None:
+                index = frame_index[frame] = len(frames)
+                frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            indices.append(index)
+        samples.append(indices)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'request_profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': duration,
+            'samples': samples,
+            'weights': recording['weights'],
+        }],
+    }
+
+
+def _store_profile(metadata, data):
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    path = os.path.join(PROFILER_DIR, f"{metadata['id']}.{metadata['format']}")
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(os.path.join(PROFILER_DIR, f"{metadata['id']}.json"), 'w') as f:
+        json.dump(metadata, f)
+    _prune_profiles()
+
+
+def _prune_profiles():
+    # Keep only the newest PROFILER_KEEP profiles, whichever worker recorded them.
+    profiles = list_profiles()
+    for metadata in profiles[PROFILER_KEEP:]:
+        for suffix in ('json', metadata.get('format')):
+            try:
+                os.remove(os.path.join(PROFILER_DIR, f"{metadata['id']}.{suffix}"))
+            except OSError:
+                pass
+
+
+def list_profiles():
+    """Metadata of the stored profiles, newest first."""
+    if not os.path.isdir(PROFILER_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILER_DIR):
+        if not name.endswith('.json') or len(name) != PROFILE_ID_LENGTH + len('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILER_DIR, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda metadata: metadata['started_at'], reverse=True)
+    return profiles
+
+
+def _profile_requested():
+    # A forced profile needs the admin token so clients cannot slow the server down at will.
+    if request.headers.get('X-Profile', '').lower() in ('1', 'true'):
+        return check_admin_token() is None, True
+    return random.random() < PROFILER_SAMPLE_RATE, False
+
+
+def _start_profile():
+    selected, forced = _profile_requested()
+    if not selected:
+        return
+    g.profile_forced = forced
+    g.profile_started = time.perf_counter()
+    g.profile_started_at = time.time()
+    if PROFILER_MODE == 'cprofile':
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is already active on this thread.
+            logging.warning(f"Request profiling skipped: {e}")
+            return
+        g.profile = profile
+    else:
+        _sampler.start(threading.get_ident())
+        g.profile = _sampler
+
+
+def _stop_profile():
+    """Stop profiling the current request. Returns ``(profile, sampler_recording)`` or None."""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    if profile is _sampler:
+        return profile, _sampler.stop(threading.get_ident())
+    profile.disable()
+    return profile, None
+
+
+def _finish_profile(response):
+    stopped = _stop_profile()
+    if stopped is None:
+        return response
+    profile, recording = stopped
+    duration = time.perf_counter() - g.profile_started
+    if duration * 1000 < PROFILER_THRESHOLD_MS and not g.profile_forced:
+        return response
+
+    name = f"{request.method} {request.path}"
+    metadata = {
+        'id': uuid.uuid4().hex,
+        'route': request.url_rule.rule if request.url_rule is not None else None,
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'started_at': g.profile_started_at,
+        'pid': os.getpid(),
+        'mode': 'sampling' if profile is _sampler else 'cprofile',
+    }
+    try:
+        if profile is _sampler:
+            metadata['format'] = 'speedscope.json'
+            metadata['samples'] = len(recording['samples']) if recording else 0
+            data = json.dumps(speedscope_profile(recording or {'samples': [], 'weights': []}, name, duration)).encode('utf-8')
+        else:
+            metadata['format'] = 'pstats'
+            profile.create_stats()
+            data = marshal.dumps(profile.stats)
+        _store_profile(metadata, data)
+    except OSError as e:
+        logging.warning(f"Could not store request profile: {e}")
+    return response
+
+
+def install_profiler(app):
+    """Register the profiling hooks on ``app``. Nothing is added to the request path unless this is called."""
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    # Requests that fail before after_request runs must still be stopped.
+    app.teardown_request(lambda exc: _stop_profile())
+
+
+@profiler_bp.route('/profiles', methods=['GET'])
+def profiles_list():
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+    return jsonify({'enabled': PROFILER_ENABLED, 'mode': PROFILER_MODE, 'profiles': list_profiles()})
+
+
+@profiler_bp.route('/profiles/<profile_id>', methods=['GET'])
+def profile_download(profile_id):
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+    metadata = next((item for item in list_profiles() if item['id'] == profile_id), None)
+    if metadata is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    path = os.path.join(PROFILER_DIR, f"{metadata['id']}.{metadata['format']}")
+    mimetype = 'application/json' if metadata['format'].endswith('json') else 'application/octet-stream'
+    return send_file(path, mimetype=mimetype, as_attachment=True,
+                     download_name=f"profile-{metadata['id']}.{metadata['format']}")
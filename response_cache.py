@@ -0,0 +1,356 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_credential(credential):
+    return hashlib.sha256(str(credential or '').encode('utf-8')).hexdigest()
+
+
+def make_cache_key(params, credential):
+    # params is the already-normalized dict sent upstream; sorting makes the key
+    # independent of the order the client supplied the fields in.
+    canonical = json.dumps(params, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(f"{hash_credential(credential)}|{canonical}".encode('utf-8')).hexdigest()
+
+
+def value_size(value):
+    return len(json.dumps(value).encode('utf-8'))
+
+
+class MemoryBackend:
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        # Sizes are only measured (as serialized JSON) when a byte limit is set.
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        """Return ``(value, fresh_until)``, or ``(None, None)`` when the key is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            value, expires_at, size, fresh_until = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.total_bytes -= size
+                return None, None
+            self._entries.move_to_end(key)
+            return value, fresh_until
+
+    def set(self, key, value, expires_at, fresh_until=None):
+        fresh_until = expires_at if fresh_until is None else fresh_until
+        size = value_size(value) if self.max_bytes else 0
+        evicted = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[2]
+            if self.max_bytes and size > self.max_bytes:
+                return 0
+            self._entries[key] = (value, expires_at, size, fresh_until)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+                _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                evicted += 1
+        return evicted
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return 0
+            self.total_bytes -= entry[2]
+            return 1
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                self.total_bytes -= self._entries.pop(key)[2]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self.total_bytes = 0
+        return count
+
+    def size_bytes(self):
+        return self.total_bytes if self.max_bytes else None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SqliteBackend:
+    """Cache backend shared by every worker process through one sqlite file."""
+
+    def __init__(self, path, max_entries, max_bytes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " fresh_until REAL)"
+        )
+        # Cache files created before the size and fresh_until columns existed.
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+        if 'size' not in columns:
+            conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+        if 'fresh_until' not in columns:
+            conn.execute("ALTER TABLE cache ADD COLUMN fresh_until REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        conn.commit()
+
+    def _connect(self):
+        # sqlite connections must not cross threads, so each thread gets its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, now):
+        conn = self._connect()
+        row = conn.execute("SELECT value, expires_at, fresh_until FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, None
+        value, expires_at, fresh_until = row
+        if expires_at <= now:
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+            return None, None
+        conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(value), expires_at if fresh_until is None else fresh_until
+
+    def set(self, key, value, expires_at, fresh_until=None):
+        conn = self._connect()
+        now = time.time()
+        serialized = json.dumps(value)
+        size = len(serialized.encode('utf-8'))
+        if self.max_bytes and size > self.max_bytes:
+            self.delete(key)
+            return 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, last_access, size, fresh_until) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, serialized, expires_at, now, size, expires_at if fresh_until is None else fresh_until)
+            )
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            overflow = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            evicted = 0
+            if overflow > 0:
+                evicted = conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)",
+                    (overflow,)
+                ).rowcount
+            if self.max_bytes:
+                excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0] - self.max_bytes
+                if excess > 0:
+                    oldest = []
+                    for old_key, old_size in conn.execute("SELECT key, size FROM cache ORDER BY last_access"):
+                        if excess <= 0:
+                            break
+                        oldest.append((old_key,))
+                        excess -= old_size
+                    conn.executemany("DELETE FROM cache WHERE key = ?", oldest)
+                    evicted += len(oldest)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return evicted
+
+    def delete(self, key):
+        return self._connect().execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount
+
+    def delete_prefix(self, prefix):
+        return self._connect().execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)).rowcount
+
+    def clear(self):
+        return self._connect().execute("DELETE FROM cache").rowcount
+
+    def size_bytes(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class CacheGenerations:
+    """Invalidation counters shared by every worker process through one sqlite file.
+
+    Callers put ``current(scope)`` into their cache keys; ``bump(scope)`` then makes
+    every worker miss the old entries, whichever backend holds them. Scope ``''``
+    is global.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS generations (scope TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def current(self, scope):
+        """Return ``'<global>.<scope>'``, the generation to include in a key for ``scope``."""
+        rows = dict(self._connect().execute(
+            "SELECT scope, generation FROM generations WHERE scope IN ('', ?)", (scope,)
+        ).fetchall())
+        return f"{rows.get('', 0)}.{rows.get(scope, 0)}"
+
+    def bump(self, scope=''):
+        self._connect().execute(
+            "INSERT INTO generations (scope, generation) VALUES (?, 1)"
+            " ON CONFLICT (scope) DO UPDATE SET generation = generation + 1", (scope,)
+        )
+
+
+class ResponseCache:
+    def __init__(self, backend, default_ttl, enabled=True, stale_ttl=0):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.enabled = enabled
+        # Entries outlive their TTL by stale_ttl seconds; get() ignores them, get_stale() does not.
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()
+
+    def _lookup(self, key):
+        try:
+            return self.backend.get(key, time.time())
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache read failed: {e}")
+            return None, None
+
+    def get(self, key):
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key, max_stale=0):
+        """Return ``(value, fresh_until)`` if ``key`` is fresh or expired at most ``max_stale`` seconds ago, else ``(None, None)``."""
+        if not self.enabled:
+            return None, None
+        value, fresh_until = self._lookup(key)
+        now = time.time()
+        with self._stats_lock:
+            if fresh_until is not None and fresh_until > now:
+                self.hits += 1
+            elif fresh_until is not None and fresh_until + max_stale > now:
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+                return None, None
+        return value, fresh_until
+
+    def peek(self, key):
+        """``(value, fresh_until)`` of any stored entry for ``key``, without counting towards the stats."""
+        if not self.enabled:
+            return None, None
+        return self._lookup(key)
+
+    def get_stale(self, key):
+        """Return the entry for ``key`` even if its TTL has passed (within stale_ttl), else None."""
+        if not self.enabled:
+            return None
+        value, fresh_until = self._lookup(key)
+        if fresh_until is None:
+            return None
+        if fresh_until <= time.time():
+            with self._stats_lock:
+                self.stale_hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        fresh_until = time.time() + ttl
+        try:
+            evicted = self.backend.set(key, value, fresh_until + self.stale_ttl, fresh_until)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+            return
+        if evicted:
+            with self._stats_lock:
+                self.evictions += evicted
+
+    def invalidate(self, key=None, prefix=None):
+        """Drop one key, every key starting with ``prefix``, or (with neither) everything. Returns the count dropped."""
+        if key is not None:
+            return self.backend.delete(key)
+        if prefix is not None:
+            return self.backend.delete_prefix(prefix)
+        return self.backend.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses, stale_hits, evictions = self.hits, self.misses, self.stale_hits, self.evictions
+        lookups = hits + misses
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'bytes': self.backend.size_bytes(),
+            'hits': hits,
+            'misses': misses,
+            'stale_hits': stale_hits,
+            'evictions': evictions,
+            'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_cache(prefix, default_ttl, max_entries, max_bytes=0, stale_ttl=0):
+    """Build a ResponseCache from ``<prefix>_CACHE_*`` environment variables."""
+    enabled = os.environ.get(f'{prefix}_CACHE_ENABLED', 'true').lower() == 'true'
+    max_entries = int(os.environ.get(f'{prefix}_CACHE_MAX_ENTRIES', max_entries))
+    # 0 means no byte limit.
+    max_bytes = int(os.environ.get(f'{prefix}_CACHE_MAX_BYTES', max_bytes)) or None
+    default_ttl = float(os.environ.get(f'{prefix}_CACHE_DEFAULT_TTL', default_ttl))
+    stale_ttl = float(os.environ.get(f'{prefix}_CACHE_STALE_TTL', stale_ttl))
+    backend_name = os.environ.get(f'{prefix}_CACHE_BACKEND', 'memory').lower()
+
+    if backend_name == 'sqlite':
+        path = os.environ.get(f'{prefix}_CACHE_SQLITE_PATH', f"/tmp/{prefix.lower()}_cache.sqlite3")
+        try:
+            backend = SqliteBackend(path, max_entries, max_bytes)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not open sqlite cache at {path} ({e}). Falling back to in-memory cache.")
+            backend = MemoryBackend(max_entries, max_bytes)
+    else:
+        backend = MemoryBackend(max_entries, max_bytes)
+    return ResponseCache(backend, default_ttl, enabled=enabled, stale_ttl=stale_ttl)
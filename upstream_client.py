@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from upstream_guard import get_guard, is_upstream_failure
+
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.5))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Longest Retry-After an upstream can make a worker thread sleep before a retry.
+MAX_RETRY_AFTER = float(os.environ.get('UPSTREAM_MAX_RETRY_AFTER', 5))
+# Image URLs are user-supplied, so the number of hosts with a session is capped.
+MAX_SESSIONS = int(os.environ.get('UPSTREAM_MAX_SESSIONS', 32))
+# Threads that run a hedged call's two attempts. A call is only hedged while two
+# of them are idle; otherwise it runs on the calling thread like any other.
+HEDGE_THREADS = int(os.environ.get('UPSTREAM_HEDGE_THREADS', 32))
+# Only these are retried or hedged unless the caller says the request is idempotent.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD'])
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+_hedge_executors = {}
+
+
+class _CappedRetry(Retry):
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+class RejectCookies(DefaultCookiePolicy):
+    # Sessions are shared by every user of a host, so they must not carry cookies between them.
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def _build_session(idempotent):
+    retry = _CappedRetry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=IDEMPOTENT_METHODS | {'POST'} if idempotent else IDEMPOTENT_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.cookies.set_policy(RejectCookies())
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(url, idempotent=False):
+    """Return the keep-alive session for ``url``'s host in the current worker process.
+
+    With ``idempotent``, POST requests are retried as well. The least recently used
+    sessions are closed beyond UPSTREAM_MAX_SESSIONS.
+    """
+    parts = urlsplit(url)
+    # Keyed on the pid as well so a forked gunicorn worker never reuses the
+    # parent's sockets.
+    key = (os.getpid(), parts.scheme, parts.netloc, idempotent)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = _build_session(idempotent)
+            while len(_sessions) > MAX_SESSIONS:
+                _, evicted = _sessions.popitem(last=False)
+                evicted.close()
+        else:
+            _sessions.move_to_end(key)
+    return session
+
+
+def request(method, url, idempotent=False, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session(url, idempotent).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def _hedge_pool():
+    """Return this worker's hedge executor and the semaphore counting its idle threads."""
+    pool = _hedge_executors.get(os.getpid())
+    if pool is None:
+        with _sessions_lock:
+            pool = _hedge_executors.setdefault(os.getpid(), (
+                ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='upstream-hedge'),
+                threading.BoundedSemaphore(HEDGE_THREADS),
+            ))
+    return pool
+
+
+def _reserve_hedge_threads():
+    """Reserve two idle hedge threads, so neither attempt waits in the executor's queue. Returns the pool or None."""
+    executor, idle = _hedge_pool()
+    if not idle.acquire(blocking=False):
+        return None
+    if not idle.acquire(blocking=False):
+        idle.release()
+        return None
+    return executor, idle
+
+
+def _discard(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _hedged_request(guard, delay, pool, method, url, kwargs):
+    # The calling thread cannot be interrupted once it is waiting on a socket, so
+    # both attempts run on the reserved hedge threads while the caller waits.
+    executor, idle = pool
+    primary = executor.submit(request, method, url, **kwargs)
+    primary.add_done_callback(lambda future: idle.release())
+    try:
+        response = primary.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    else:
+        idle.release()
+        return response
+    if not guard.take_hedge():
+        idle.release()
+        return primary.result()
+
+    hedge = executor.submit(request, method, url, **kwargs)
+    hedge.add_done_callback(lambda future: idle.release())
+    pending = {primary, hedge}
+    first_done = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            first_done = first_done or future
+            if future.exception() is None and not is_upstream_failure(future.result().status_code):
+                guard.record_hedge(future is hedge)
+                # The other attempt cannot be interrupted; release its connection when it ends.
+                (hedge if future is primary else primary).add_done_callback(_discard)
+                return future.result()
+    # Both attempts failed, so neither won: report the one that finished first.
+    (hedge if first_done is primary else primary).add_done_callback(_discard)
+    return first_done.result()
+
+
+def guarded_request(upstream, method, url, credential=None, idempotent=False, **kwargs):
+    """request() behind the circuit breaker of ``url`` and ``credential``, hedged once its p95 latency is known.
+
+    Only GET and HEAD requests are retried and hedged, unless ``idempotent`` is set.
+    Raises upstream_guard.CircuitOpenError without calling the upstream while its breaker is open.
+    """
+    guard = get_guard(upstream, url, credential)
+    guard.before_request()
+    start = time.perf_counter()
+    kwargs['idempotent'] = idempotent
+    try:
+        delay = guard.hedge_delay() if idempotent or method in IDEMPOTENT_METHODS else None
+        # Without hedge budget or idle hedge threads the call simply runs on this thread.
+        pool = _reserve_hedge_threads() if delay is not None and guard.can_hedge() else None
+        if pool is None:
+            response = request(method, url, **kwargs)
+        else:
+            response = _hedged_request(guard, delay, pool, method, url, kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        guard.record_failure()
+        raise
+    except BaseException:
+        guard.release()
+        raise
+    guard.record_response(response.status_code, time.perf_counter() - start)
+    return response
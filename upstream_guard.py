@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+from metrics import registry, METRICS_ENABLED
+from rate_limiter import RateLimitExceeded
+from response_cache import hash_credential
+
+# Hedging: once an upstream has HEDGE_MIN_SAMPLES recent latencies, a call that
+# has not answered after their HEDGE_PERCENTILE gets a second, identical attempt
+# and the first good response wins. Every call earns HEDGE_BUDGET hedge tokens
+# (at most HEDGE_BURST banked), so hedges stay a bounded share of upstream traffic.
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'true').lower() == 'true'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.95))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+HEDGE_WINDOW = int(os.environ.get('HEDGE_WINDOW', 200))
+HEDGE_MIN_DELAY_MS = float(os.environ.get('HEDGE_MIN_DELAY_MS', 10))
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.05))
+HEDGE_BURST = float(os.environ.get('HEDGE_BURST', 5))
+
+# Circuit breaker: after BREAKER_FAILURE_THRESHOLD consecutive failures an upstream
+# endpoint is skipped for BREAKER_RESET_TIMEOUT seconds, then a single trial call
+# decides whether it closes again. Breakers and latencies are kept per endpoint URL
+# and credential, so one user's broken pipeline or exhausted key affects only them.
+BREAKER_ENABLED = os.environ.get('BREAKER_ENABLED', 'true').lower() == 'true'
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+# Least recently used guards beyond this many per worker are dropped.
+GUARD_MAX_ENTRIES = int(os.environ.get('UPSTREAM_GUARD_MAX_ENTRIES', 1024))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_guards = OrderedDict()
+_guards_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, upstream, host, retry_after):
+        super().__init__(f"{upstream} upstream {host} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.upstream = upstream
+        self.host = host
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(status_code):
+    """Responses that count against the breaker. 4xx, 429 included, concern one caller's request or quota."""
+    return status_code >= 500
+
+
+def is_unavailable_status(status_code):
+    """Responses that a stale cached result may stand in for."""
+    return status_code >= 500 or status_code == 429
+
+
+def is_unavailable_error(err, network_errors=(OSError,)):
+    """True if ``err`` means the upstream is down or overloaded, rather than that the request was bad.
+
+    requests exceptions are OSErrors; pass the transport error types of other clients in ``network_errors``.
+    """
+    if isinstance(err, (CircuitOpenError, RateLimitExceeded)):
+        return True
+    response = getattr(err, 'response', None)
+    if response is not None:
+        return is_unavailable_status(response.status_code)
+    return isinstance(err, network_errors)
+
+
+def _count(name, labels, amount=1):
+    if METRICS_ENABLED:
+        registry.inc(name, labels, amount)
+
+
+class UpstreamGuard:
+    """Latency window, hedge budget and circuit breaker of one upstream host in one worker."""
+
+    def __init__(self, upstream, host):
+        self.upstream = upstream
+        self.host = host
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.hedge_tokens = HEDGE_BURST
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def _set_state(self, state):
+        # Called with self.lock held.
+        self.state = state
+        _count('plugin_circuit_breaker_transitions_total', {'upstream': self.upstream, 'state': state})
+        if METRICS_ENABLED:
+            pid = os.getpid()
+            # get_guard never takes a guard's lock while holding _guards_lock, so this cannot deadlock.
+            with _guards_lock:
+                open_count = sum(1 for key, guard in _guards.items()
+                                 if key[0] == pid and guard.upstream == self.upstream and guard.state == OPEN)
+            registry.set_gauge('plugin_circuit_breakers_open', {'upstream': self.upstream}, open_count)
+
+    def before_request(self):
+        """Raise CircuitOpenError if calls to this host are currently being skipped."""
+        with self.lock:
+            self.hedge_tokens = min(HEDGE_BURST, self.hedge_tokens + HEDGE_BUDGET)
+            if not BREAKER_ENABLED:
+                return
+            if self.state == OPEN:
+                remaining = self.opened_at + BREAKER_RESET_TIMEOUT - time.monotonic()
+                if remaining > 0:
+                    error = CircuitOpenError(self.upstream, self.host, remaining)
+                else:
+                    self._set_state(HALF_OPEN)
+                    error = None
+            else:
+                error = None
+            if error is None and self.state == HALF_OPEN:
+                if self.trial_in_flight:
+                    error = CircuitOpenError(self.upstream, self.host, 0)
+                else:
+                    self.trial_in_flight = True
+        if error is not None:
+            _count('plugin_upstream_requests_total', {'upstream': self.upstream, 'outcome': 'rejected'})
+            raise error
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None while there are too few samples."""
+        if not HEDGE_ENABLED:
+            return None
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(HEDGE_PERCENTILE * len(ordered)))
+        return max(ordered[index], HEDGE_MIN_DELAY_MS / 1000)
+
+    def can_hedge(self):
+        with self.lock:
+            return self.hedge_tokens >= 1
+
+    def take_hedge(self):
+        with self.lock:
+            if self.hedge_tokens < 1:
+                return False
+            self.hedge_tokens -= 1
+            return True
+
+    def record_hedge(self, hedge_won):
+        _count('plugin_upstream_hedges_total', {'upstream': self.upstream, 'winner': 'hedge' if hedge_won else 'primary'})
+
+    def record_response(self, status_code, elapsed):
+        if is_upstream_failure(status_code):
+            self.record_failure()
+            return
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.failures = 0
+            self.trial_in_flight = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+        _count('plugin_upstream_requests_total', {'upstream': self.upstream, 'outcome': 'success'})
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= BREAKER_FAILURE_THRESHOLD):
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+        _count('plugin_upstream_requests_total', {'upstream': self.upstream, 'outcome': 'failure'})
+
+    def release(self):
+        """End a call that neither succeeded nor failed (e.g. an invalid URL), freeing a half-open trial."""
+        with self.lock:
+            self.trial_in_flight = False
+
+
+def get_guard(upstream, url, credential=None):
+    """Return the guard of endpoint ``url`` and ``credential`` for ``upstream`` in the current worker process."""
+    parts = urlsplit(url)
+    endpoint = f"{parts.scheme}://{parts.netloc}{parts.path}"
+    # Keyed on the pid so a forked worker starts with its own breakers and latencies.
+    key = (os.getpid(), upstream, endpoint, hash_credential(credential))
+    with _guards_lock:
+        guard = _guards.get(key)
+        if guard is None:
+            guard = UpstreamGuard(upstream, endpoint)
+            _guards[key] = guard
+            while len(_guards) > GUARD_MAX_ENTRIES:
+                _guards.popitem(last=False)
+        else:
+            _guards.move_to_end(key)
+    return guard
+
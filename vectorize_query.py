@@ -1,9 +1,328 @@
 from flask import Flask, request, jsonify, make_response, Blueprint
 from flask_cors import CORS
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import re
 import requests
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import json_codec
+import upstream_client
+from upstream_guard import CircuitOpenError, is_unavailable_error, is_unavailable_status
+from rate_limiter import RateLimitExceeded, limit as rate_limit
+from admin_auth import check_admin_token
+from response_cache import CacheGenerations, create_cache, make_cache_key
+from single_flight import SingleFlight
+from metrics import record_upstream_bytes, stage
 
 vectorize_query_bp = Blueprint('vectorize_query', __name__)
-CORS(vectorize_query_bp, resources={r"/vectorize-rag-retrieve": {"origins": "*"}})
+CORS(vectorize_query_bp, resources={r"/vectorize-rag-retrieve": {"origins": "*"}, r"/vectorize-rag-retrieve/batch": {"origins": "*"}})
+vectorize_flight = SingleFlight()
+
+# Retrieval results are cached per endpoint, access token, numResults, rerank and
+# normalized question. Pipelines are re-indexed at different rates, so
+# VECTORIZE_CACHE_ENDPOINT_TTLS can override the TTL for an endpoint URL (or a
+# prefix of it), e.g. {"https://api.vectorize.io/v1/org/o/pipelines/p": 60}.
+# Expired results are kept for VECTORIZE_CACHE_STALE_TTL more seconds and served
+# when the endpoint is unavailable.
+vectorize_cache = create_cache('VECTORIZE', default_ttl=300, max_entries=512, max_bytes=64 * 1024 * 1024, stale_ttl=3600)
+try:
+    VECTORIZE_CACHE_ENDPOINT_TTLS = {url: float(ttl) for url, ttl in
+                                     json.loads(os.environ.get('VECTORIZE_CACHE_ENDPOINT_TTLS') or '{}').items()}
+except (ValueError, TypeError, AttributeError) as e:
+    logging.warning(f"Ignoring invalid VECTORIZE_CACHE_ENDPOINT_TTLS ({e}).")
+    VECTORIZE_CACHE_ENDPOINT_TTLS = {}
+# Invalidation bumps a generation counter that is part of every key, so it reaches
+# all workers even when each keeps its own in-memory cache.
+VECTORIZE_CACHE_GENERATIONS_PATH = os.environ.get('VECTORIZE_CACHE_GENERATIONS_PATH', '/tmp/vectorize_cache_generations.sqlite3')
+vectorize_cache_generations = CacheGenerations(VECTORIZE_CACHE_GENERATIONS_PATH)
+
+# /vectorize-rag-retrieve/batch runs the questions of one request concurrently and
+# merges their chunks, keeping at most maxChars characters of chunk text.
+VECTORIZE_BATCH_MAX_QUESTIONS = int(os.environ.get('VECTORIZE_BATCH_MAX_QUESTIONS', 10))
+VECTORIZE_BATCH_CONCURRENCY = int(os.environ.get('VECTORIZE_BATCH_CONCURRENCY', 4))
+VECTORIZE_BATCH_MAX_CHARS = int(os.environ.get('VECTORIZE_BATCH_MAX_CHARS', 20000))
+
+# Chunk fields dropped by "stripVectors". Other numeric lists (page numbers, scores)
+# and fields of nested metadata objects are kept.
+VECTOR_FIELDS = ('vector', 'vectors', 'values', 'embedding', 'embeddings')
+
+def normalize_question(question):
+    # Case, punctuation and spacing rarely change what a retrieval returns.
+    return ' '.join(re.sub(r'[^\w\s]+', ' ', str(question).casefold()).split())
+
+def vectorize_cache_prefix(retrieval_endpoint_url):
+    return hashlib.sha256(retrieval_endpoint_url.encode('utf-8')).hexdigest()[:16] + ':'
+
+def vectorize_cache_generation(retrieval_endpoint_url):
+    try:
+        return vectorize_cache_generations.current(vectorize_cache_prefix(retrieval_endpoint_url))
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read Vectorize cache generation: {e}")
+        return '0.0'
+
+def vectorize_cache_key(retrieval_endpoint_url, access_token, vectorize_payload, projection=None):
+    # Keys start with a hash of the endpoint so one endpoint's entries can be invalidated together.
+    params = dict(vectorize_payload, question=normalize_question(vectorize_payload['question']))
+    if projection is not None:
+        # Projected results are cached as projected, so each projection has its own entry.
+        params['projection'] = projection
+    prefix = vectorize_cache_prefix(retrieval_endpoint_url)
+    return f"{prefix}{vectorize_cache_generation(retrieval_endpoint_url)}:{make_cache_key(params, access_token)}"
+
+def vectorize_cache_ttl(retrieval_endpoint_url):
+    matches = [url for url in VECTORIZE_CACHE_ENDPOINT_TTLS if retrieval_endpoint_url.startswith(url)]
+    if not matches:
+        return vectorize_cache.default_ttl
+    return VECTORIZE_CACHE_ENDPOINT_TTLS[max(matches, key=len)]
+
+def projection_hook(projection):
+    """json.loads object_hook that trims every chunk as soon as it is decoded.
+
+    Unwanted fields and vectors are dropped before the next chunk is parsed, so the
+    decoded result never holds more than one untrimmed chunk. The raw response body
+    is still read in full, and each vector is decoded before it is dropped.
+    """
+    fields = set(projection['fields']) if projection['fields'] else None
+    max_chunk_chars = projection['max_chunk_chars']
+    strip_vectors = projection['strip_vectors']
+
+    def hook(obj):
+        # Chunks are the objects carrying a text field. Nested objects, such as a
+        # chunk's metadata, are left alone.
+        if isinstance(obj.get('text'), str):
+            if strip_vectors:
+                for key in VECTOR_FIELDS:
+                    obj.pop(key, None)
+            if fields is not None:
+                obj = {key: value for key, value in obj.items() if key in fields}
+            text = obj.get('text')
+            if max_chunk_chars and isinstance(text, str) and len(text) > max_chunk_chars:
+                obj['text'] = text[:max_chunk_chars] + '…'
+        return obj
+    return hook
+
+def parse_projected_results(content, projection):
+    result = json.loads(content, object_hook=projection_hook(projection))
+    top_k = projection['top_k']
+    if top_k and isinstance(result, dict) and isinstance(result.get('documents'), list):
+        # Documents whose score fields were projected away keep the upstream order.
+        result['documents'] = sorted(result['documents'], key=document_score, reverse=True)[:top_k]
+    return result
+
+def parse_vectorize_projection(data):
+    """Return ``(projection, error_message)``. projection is None unless the request asked for one."""
+    fields = data.get('fields')
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(field, str) for field in fields)):
+        return None, 'fields must be a list of field names'
+    limits = {}
+    for name in ('maxChunkChars', 'topK'):
+        value = data.get(name)
+        try:
+            limits[name] = int(value) if value else None
+        except (ValueError, TypeError):
+            return None, f'{name} must be an integer'
+        if limits[name] is not None and limits[name] <= 0:
+            return None, f'{name} must be positive'
+    strip_vectors = str(data.get('stripVectors', False)).lower() == 'true'
+    if not fields and not limits['maxChunkChars'] and not limits['topK'] and not strip_vectors:
+        return None, None
+    return {
+        'fields': sorted(set(fields)) if fields else None,
+        'max_chunk_chars': limits['maxChunkChars'],
+        'top_k': limits['topK'],
+        'strip_vectors': strip_vectors,
+    }, None
+
+def format_vectorize_documents(documents):
+    """Compact plain-text rendering of retrieved chunks, for ``"responseFormat": "text"``."""
+    if not documents:
+        return 'No relevant documents found.'
+    formatted_items = []
+    for i, document in enumerate(documents):
+        details = []
+        source = document.get('source_display_name') or document.get('source')
+        if source:
+            details.append(f'source: {source}')
+        score = document.get('relevancy', document.get('similarity'))
+        if isinstance(score, (int, float)):
+            details.append(f'score: {score:.3f}')
+        header = f"Result {i+1}" + (f" ({', '.join(details)})" if details else '')
+        formatted_items.append(f"{header}:\n{str(document.get('text', '')).strip()}")
+    return '\n\n'.join(formatted_items)
+
+def fetch_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, projection=None):
+    """Return ``(None, results)`` on success or ``(status_code, error_text)``."""
+    # Make request to Vectorize
+    with rate_limit('vectorize', access_token), stage('upstream'):
+        vectorize_response = upstream_client.guarded_request(
+            'vectorize',
+            'POST',
+            retrieval_endpoint_url,
+            credential=access_token,
+            # Retrieval only reads the index, so the POST may be retried and hedged.
+            idempotent=True,
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': access_token
+            },
+            json=vectorize_payload
+        )
+    record_upstream_bytes('vectorize', len(vectorize_response.content))
+    
+    if not vectorize_response.ok:
+        return vectorize_response.status_code, vectorize_response.text
+    
+    with stage('parse'):
+        if projection is not None:
+            return None, parse_projected_results(vectorize_response.content, projection)
+        return None, json_codec.loads(vectorize_response.content)
+
+def fetch_and_cache_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, cache_key, projection=None):
+    status_code, result = fetch_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, projection)
+    # Only successful retrievals are cached.
+    if status_code is None:
+        vectorize_cache.set(cache_key, result, ttl=vectorize_cache_ttl(retrieval_endpoint_url))
+    return status_code, result
+
+def retrieve_vectorize(retrieval_endpoint_url, access_token, vectorize_payload, projection=None):
+    """Cached and coalesced fetch_vectorize_results."""
+    cache_key = vectorize_cache_key(retrieval_endpoint_url, access_token, vectorize_payload, projection)
+    cached_result = vectorize_cache.get(cache_key)
+    if cached_result is not None:
+        return None, cached_result
+
+    # Identical retrievals arriving while one is already in flight share its result.
+    try:
+        status_code, result = vectorize_flight.do(
+            cache_key,
+            lambda: fetch_and_cache_vectorize_results(retrieval_endpoint_url, access_token, vectorize_payload, cache_key, projection)
+        )
+    except Exception as e:
+        stale_result = vectorize_cache.get_stale(cache_key) if is_unavailable_error(e) else None
+        if stale_result is None:
+            raise
+        logging.warning(f"Vectorize endpoint unavailable ({e}). Serving stale result.")
+        return None, stale_result
+    if status_code is not None and is_unavailable_status(status_code):
+        stale_result = vectorize_cache.get_stale(cache_key)
+        if stale_result is not None:
+            logging.warning(f"Vectorize endpoint returned {status_code}. Serving stale result.")
+            return None, stale_result
+    return status_code, result
+
+def document_score(document):
+    # Reranked results carry a relevancy score; otherwise fall back to vector similarity.
+    score = document.get('relevancy', document.get('similarity'))
+    return score if isinstance(score, (int, float)) else 0
+
+def document_identity(document):
+    if document.get('id') is not None:
+        return f"id:{document['id']}"
+    return 'text:' + hashlib.sha256(str(document.get('text', '')).encode('utf-8')).hexdigest()
+
+def merge_vectorize_results(results, max_chars):
+    """Merge ``[(question, vectorize_response), ...]`` into one score-ordered, de-duplicated document list.
+
+    Chunks returned for several questions are kept once, with their best score, and list
+    every question they matched. Documents are added in score order, skipping any whose
+    text would take the total over ``max_chars``.
+    """
+    merged = {}
+    for question, result in results:
+        for document in result.get('documents') or []:
+            if not isinstance(document, dict):
+                continue
+            identity = document_identity(document)
+            existing = merged.get(identity)
+            if existing is None:
+                merged[identity] = dict(document, matched_questions=[question])
+                continue
+            if question not in existing['matched_questions']:
+                existing['matched_questions'].append(question)
+            if document_score(document) > document_score(existing):
+                merged[identity] = dict(document, matched_questions=existing['matched_questions'])
+
+    documents = []
+    total_chars = 0
+    ordered = sorted(merged.values(), key=document_score, reverse=True)
+    for document in ordered:
+        text_length = len(str(document.get('text', '')))
+        if total_chars + text_length > max_chars:
+            continue
+        documents.append(document)
+        total_chars += text_length
+    return {
+        'documents': documents,
+        'total_chars': total_chars,
+        'truncated': len(documents) < len(ordered),
+        'duplicates_removed': sum(len(result.get('documents') or []) for _, result in results) - len(merged),
+    }
+
+def parse_vectorize_request(data):
+    """Return ``(access_token, retrieval_endpoint_url, vectorize_payload, error_message)``."""
+    access_token = data.get('accessToken')
+    retrieval_endpoint_url = data.get('retrievalEndpointURL')
+    question = data.get('question')
+    num_results = data.get('numResults')
+
+    if not num_results:
+        num_results = 5
+    else:
+        try:
+            num_results = int(num_results)
+            # Handle case where num_results is 0
+            if num_results <= 0:
+                num_results = 5
+        except ValueError:
+            num_results = 5
+    
+    rerank = data.get('rerank', True)
+    
+    # Validate required parameters
+    if not access_token or not retrieval_endpoint_url:
+        return None, None, None, "Missing access token or retrieval endpoint URL"
+    if not question:
+        return None, None, None, 'Search query is required'
+    
+    vectorize_payload = {
+        "question": question,
+        "numResults": num_results,
+        "rerank": rerank
+    }
+    return access_token, retrieval_endpoint_url, vectorize_payload, None
+
+@vectorize_query_bp.route('/vectorize-rag-retrieve/single_flight_stats', methods=['GET'])
+def vectorize_single_flight_stats():
+    return jsonify(vectorize_flight.stats())
+
+@vectorize_query_bp.route('/vectorize-rag-retrieve/cache_stats', methods=['GET'])
+def vectorize_cache_stats():
+    return jsonify(vectorize_cache.stats())
+
+@vectorize_query_bp.route('/vectorize-rag-retrieve/cache/invalidate', methods=['POST'])
+def vectorize_cache_invalidate():
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+    data = request.get_json(silent=True) or {}
+    retrieval_endpoint_url = data.get('retrievalEndpointURL')
+    scope = vectorize_cache_prefix(retrieval_endpoint_url) if retrieval_endpoint_url else ''
+    try:
+        vectorize_cache_generations.bump(scope)
+    except sqlite3.Error as e:
+        logging.error(f"Could not bump Vectorize cache generation: {e}")
+        return jsonify({'error': 'The cache could not be invalidated on every worker. Please retry.'}), 503
+    # Other workers stop using their old entries through the new generation; this
+    # one also frees the memory right away.
+    if scope:
+        invalidated = vectorize_cache.invalidate(prefix=scope)
+    else:
+        invalidated = vectorize_cache.invalidate()
+    return jsonify({'invalidated': invalidated})
 
 @vectorize_query_bp.route('/vectorize-rag-retrieve', methods=['OPTIONS', 'POST'])
 def vectorize_rag_retrieve():
@@ -20,56 +339,108 @@ def vectorize_rag_retrieve():
         if not data:
             return jsonify({'error': 'No JSON data provided'}), 400
         
-        access_token = data.get('accessToken')
-        retrieval_endpoint_url = data.get('retrievalEndpointURL')
-        question = data.get('question')
-        num_results = data.get('numResults')
-
-        if not num_results:
-            num_results = 5
-        else:
-            try:
-                num_results = int(num_results)
-                # Handle case where num_results is 0
-                if num_results <= 0:
-                    num_results = 5
-            except ValueError:
-                num_results = 5
+        access_token, retrieval_endpoint_url, vectorize_payload, error_message = parse_vectorize_request(data)
+        if not error_message:
+            projection, error_message = parse_vectorize_projection(data)
+        if error_message:
+            return jsonify({'error': error_message}), 400
         
-        rerank = data.get('rerank', True)
+        status_code, result = retrieve_vectorize(retrieval_endpoint_url, access_token, vectorize_payload, projection)
         
-        # Validate required parameters
-        if not access_token or not retrieval_endpoint_url:
+        if status_code is not None:
             return jsonify({
-                "error": "Missing access token or retrieval endpoint URL"
-            }), 400
-        if not question:
-            return jsonify({'error': 'Search query is required'}), 400
+                "error": f"Vectorize API error: {result}"
+            }), status_code
         
-        vectorize_payload = {
-            "question": question,
-            "numResults": num_results,
-            "rerank": rerank
-        }
-        
-        # Make request to Vectorize
-        vectorize_response = requests.post(
-            retrieval_endpoint_url,
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': access_token
-            },
-            json=vectorize_payload
-        )
-        
-        if not vectorize_response.ok:
-            return jsonify({
-                "error": f"Vectorize API error: {vectorize_response.text}"
-            }), vectorize_response.status_code
-        
-        return jsonify(vectorize_response.json())
+        if str(data.get('responseFormat', 'json')).lower() == 'text':
+            with stage('format'):
+                return jsonify({'retrieval_summary': format_vectorize_documents(result.get('documents'))})
+        return jsonify(result)
     
+    except CircuitOpenError as e:
+        return jsonify({'error': f'Vectorize API temporarily unavailable: {str(e)}'}), 503
+    except RateLimitExceeded as e:
+        return jsonify({'error': f'Vectorize API rate limit reached: {str(e)}'}), 429, {'Retry-After': e.retry_after_header}
     except requests.exceptions.RequestException as e:
         return jsonify({'error': f'Request error: {str(e)}'}), 500
     except Exception as e:
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+@vectorize_query_bp.route('/vectorize-rag-retrieve/batch', methods=['OPTIONS', 'POST'])
+def vectorize_rag_retrieve_batch():
+    if request.method == 'OPTIONS':
+        response = make_response()
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+        response.headers.add('Access-Control-Allow-Methods', 'POST')
+        return response
+
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+
+        questions = data.get('questions')
+        if not isinstance(questions, list) or not questions:
+            return jsonify({'error': 'A non-empty list of questions is required'}), 400
+        if len(questions) > VECTORIZE_BATCH_MAX_QUESTIONS:
+            return jsonify({'error': f'At most {VECTORIZE_BATCH_MAX_QUESTIONS} questions are allowed per batch'}), 400
+        try:
+            max_chars = int(data.get('maxChars') or VECTORIZE_BATCH_MAX_CHARS)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'maxChars must be an integer'}), 400
+        projection, error_message = parse_vectorize_projection(data)
+        if error_message:
+            return jsonify({'error': error_message}), 400
+
+        jobs = []
+        for question in dict.fromkeys(str(question) for question in questions if question):
+            # Every question goes to the same endpoint with the batch-level numResults and rerank.
+            access_token, retrieval_endpoint_url, vectorize_payload, error_message = parse_vectorize_request(
+                {**{k: v for k, v in data.items() if k not in ('questions', 'maxChars')}, 'question': question})
+            if error_message:
+                return jsonify({'error': error_message}), 400
+            jobs.append(vectorize_payload)
+        if not jobs:
+            return jsonify({'error': 'Search query is required'}), 400
+
+        with ThreadPoolExecutor(max_workers=min(len(jobs), VECTORIZE_BATCH_CONCURRENCY)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, retrieve_vectorize,
+                                       retrieval_endpoint_url, access_token, vectorize_payload, projection)
+                       for vectorize_payload in jobs]
+
+        results = []
+        errors = []
+        for vectorize_payload, future in zip(jobs, futures):
+            question = vectorize_payload['question']
+            try:
+                status_code, result = future.result()
+            except CircuitOpenError as e:
+                errors.append({'question': question, 'error': f'Vectorize API temporarily unavailable: {str(e)}', 'status_code': 503})
+                continue
+            except RateLimitExceeded as e:
+                errors.append({'question': question, 'error': f'Vectorize API rate limit reached: {str(e)}', 'status_code': 429})
+                continue
+            except requests.exceptions.RequestException as e:
+                errors.append({'question': question, 'error': f'Request error: {str(e)}', 'status_code': 500})
+                continue
+            except Exception as e:
+                # E.g. a 200 response that is not JSON; the other questions still count.
+                errors.append({'question': question, 'error': f'An error occurred: {str(e)}', 'status_code': 500})
+                continue
+            if status_code is not None:
+                errors.append({'question': question, 'error': f"Vectorize API error: {result}", 'status_code': status_code})
+                continue
+            results.append((question, result))
+
+        with stage('format'):
+            response_body = merge_vectorize_results(results, max_chars)
+            if str(data.get('responseFormat', 'json')).lower() == 'text':
+                response_body['retrieval_summary'] = format_vectorize_documents(response_body.pop('documents'))
+        response_body['questions'] = [vectorize_payload['question'] for vectorize_payload in jobs]
+        if errors:
+            response_body['errors'] = errors
+        return jsonify(response_body)
+
+    except Exception as e:
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500